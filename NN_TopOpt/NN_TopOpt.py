@@ -109,6 +109,10 @@ class FeatureMappingTopOpt:
 
         self.dc = np.ones(self.Th.me.shape[0])
 
+        # differentiable FEM solve: the compliance is computed from H inside the
+        # autograd graph (adjoint gradients) instead of from the constant ce
+        self.fem = args["fem"] if args["args"].get("autograd_fem", False) else None
+
         # self.gaussian_core = GaussianMixCompliance(dist_means, dist_stdves, self.coords, self.Emin, self.Emax, self.penal)        
         # self.gaussian_core = GaussianSplattingCompliance(dist_means, self.coords, self.Emin, self.Emax, self.penal, num_gaussian, args) 
         self.gaussian_core = top_opt_method(self.coords, self.volumes, args)
@@ -129,12 +133,18 @@ class FeatureMappingTopOpt:
             {'params': self.gaussian_core.W_offsets, 'lr': 1e-1}
         ], maximize=False, eps=1e-8)
 
+    def fem_compliance(self):
+        # differentiable objective (compliance by default) of the current H, None with constant ce
+        if self.fem is None:
+            return None
+        return self.fem.objective(self.gaussian_core.H)
+
     def parameter_opt_step(self, ce):
         # for id in range(2):
         #     _ = self.gaussian_core.get_x(self.global_i)
         self.optim.zero_grad()
         loss, splitted_loss = self.gaussian_core(
-            torch.tensor(ce), self.global_i
+            torch.from_numpy(ce), self.global_i, self.fem_compliance()
         )
         # Check for NaN before backward pass
         if torch.isnan(loss):
@@ -179,7 +189,7 @@ class FeatureMappingTopOpt:
         # Get H tensor and compute gradients
         self.optim.zero_grad()
         loss, splitted_loss = self.gaussian_core(
-            torch.tensor(ce), self.global_i
+            torch.from_numpy(ce), self.global_i, self.fem_compliance()
         )
 
         # loss.backward()
@@ -638,13 +648,18 @@ class FeatureMappingDecSDF(torch.nn.Module):
 
             return ff_loss.sum()
     
-    def forward(self, ce, global_i):
+    def forward(self, ce, global_i, compliance=None):
 
         ff_loss = self.compute_ff_loss(global_i)
 
-        # Add numerical stability to compliance calculation
-        H_vec = torch.clamp(self.H, min=self.Emin, max=self.Emax)**self.penal
-        compliance = torch.dot(H_vec, ce.float())
+        # with constant ce, -compliance has the gradient of the compliance,
+        # a compliance from the differentiable FEM solve has the exact one
+        compliance_sign = 1
+        if compliance is None:
+            # Add numerical stability to compliance calculation
+            H_vec = torch.clamp(self.H, min=self.Emin, max=self.Emax)**self.penal
+            compliance = torch.dot(H_vec, ce.to(H_vec.dtype))
+            compliance_sign = -1
 
         volfrac_goal = self.volfrac - 0.2*max(0, min(1, (global_i-20)/20))
         
@@ -663,7 +678,7 @@ class FeatureMappingDecSDF(torch.nn.Module):
         # check the sign
         # Start of Selection
         obj_ce = (
-            -compliance * self.compliance_w
+            compliance_sign * compliance * self.compliance_w
             + ff_loss * self.ff_loss_w
             + volfrac_loss_pre * self.volfrac_w
             + gaussian_overlap * self.gaussian_overlap_w
@@ -898,11 +913,16 @@ class GaussianSplattingCompliance(torch.nn.Module):
             torch.nn.utils.clip_grad_norm_(self.W_shape_var, max_norm=0.01)
             torch.nn.utils.clip_grad_norm_(self.W_rotation, max_norm=0.01)
 
-    def forward(self, ce, global_i):
+    def forward(self, ce, global_i, compliance=None):
 
-        # Add numerical stability to compliance calculation
-        H_vec = torch.clamp(self.H, min=self.Emin, max=self.Emax)**self.penal
-        compliance = torch.dot(H_vec, ce)
+        # with constant ce, -compliance has the gradient of the compliance,
+        # a compliance from the differentiable FEM solve has the exact one
+        compliance_sign = 1
+        if compliance is None:
+            # Add numerical stability to compliance calculation
+            H_vec = torch.clamp(self.H, min=self.Emin, max=self.Emax)**self.penal
+            compliance = torch.dot(H_vec, ce.to(H_vec.dtype))
+            compliance_sign = -1
 
         volfrac_goal = self.volfrac - 0.1*max(0, min(1, (global_i-20)/20))
         
@@ -919,7 +939,7 @@ class GaussianSplattingCompliance(torch.nn.Module):
         print("compliance: ", compliance)
         print("gaussian_overlap: ", gaussian_overlap)
 
-        obj_ce = -compliance*self.compliance_w + volfrac_loss_pre*self.volfrac_w + gaussian_overlap*self.gaussian_overlap_w
+        obj_ce = compliance_sign*compliance*self.compliance_w + volfrac_loss_pre*self.volfrac_w + gaussian_overlap*self.gaussian_overlap_w
         obj_real = compliance*self.compliance_w + volfrac_loss_pre*self.volfrac_w + gaussian_overlap*self.gaussian_overlap_w
 
         splitted_loss = {
@@ -1641,13 +1661,18 @@ class CombinedMappingDecoderSDF(torch.nn.Module):
         if self.if_refactoring(global_i):
             self.refactoring()
     
-    def forward(self, ce, global_i):
+    def forward(self, ce, global_i, compliance=None):
 
         rc_loss = self.compute_rc_loss(global_i)
 
-        # Add numerical stability to compliance calculation
-        H_vec = torch.clamp(self.H, min=self.Emin, max=self.Emax)**self.penal
-        compliance = torch.dot(H_vec, ce.float())
+        # with constant ce, -compliance has the gradient of the compliance,
+        # a compliance from the differentiable FEM solve has the exact one
+        compliance_sign = 1
+        if compliance is None:
+            # Add numerical stability to compliance calculation
+            H_vec = torch.clamp(self.H, min=self.Emin, max=self.Emax)**self.penal
+            compliance = torch.dot(H_vec, ce.to(H_vec.dtype))
+            compliance_sign = -1
 
         # volfrac_goal = self.volfrac - 0.1*max(0, min(1, (global_i-20)/20))
         volfrac_goal = self.volfrac - self.volfrac_increment * max(
@@ -1670,7 +1695,7 @@ class CombinedMappingDecoderSDF(torch.nn.Module):
         # check the sign
         # Start of Selection
         obj_ce = (
-            -compliance * self.compliance_w
+            compliance_sign * compliance * self.compliance_w
             + rc_loss * self.rc_loss_w
             + volfrac_loss_pre * self.volfrac_w
             + gaussian_overlap * self.gaussian_overlap_w
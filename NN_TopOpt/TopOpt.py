@@ -9,14 +9,23 @@ import time
 import json
 from random import randint, randrange
 from scipy.sparse import linalg as sla
-from scipy.sparse import coo_matrix
 
 import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 import cvxpy as cp
 
-# from NN_TopOpt.mesh_utils import LoadedMesh2D
-from mesh_utils import LoadedMesh2D
+# from NN_TopOpt.mesh_utils import LoadedMesh2D, mesh_hierarchy
+from mesh_utils import LoadedMesh2D, mesh_hierarchy
+# from NN_TopOpt.symmetry import find_mirror_symmetry
+from symmetry import find_mirror_symmetry
+# from NN_TopOpt.fem_utils import CSCAssembler, CSCSubmatrix, ElementBundle, load_bundle, CompactElements, ElementStiffnessOperator, GridStiffnessOperator, NormalEquationsOperator, classify_elements, structured_grid, element_chunks, element_compliance, element_strains, von_mises, round_significant, rigid_body_modes, dof_renumbering, stiffness_update, interpolation_matrix, select_nodes, nodal_loads
+from fem_utils import CSCAssembler, CSCSubmatrix, ElementBundle, load_bundle, CompactElements, ElementStiffnessOperator, GridStiffnessOperator, NormalEquationsOperator, classify_elements, structured_grid, element_chunks, element_compliance, element_strains, von_mises, round_significant, rigid_body_modes, dof_renumbering, stiffness_update, interpolation_matrix, select_nodes, nodal_loads
+# from NN_TopOpt.linear_solvers import get_solver
+from linear_solvers import get_solver
+# from NN_TopOpt.torch_fem import TorchFEM
+from torch_fem import TorchFEM
 
 def BuildIkFunc0():
   return lambda me,k: np.array([2*me[k,0],2*me[k,0]+1,
@@ -53,8 +62,50 @@ def ElemStiffElasMatBa2DP1(ql,V,C):
   
   return np.dot(np.dot(B.T,C),B)/(4*V)
 
+def ElemStrainMatBa2DP1_vec(q, me):
+    """ Returns the (unscaled) strain-displacement matrices of all elements,
+    batched version of the B matrix built in :func:`ElemStiffElasMatBa2DP1`.
+
+    :param q: nodes coordinates, (nq, 2) array
+    :param me: element connectivity, (nme, 3) array
+    :returns: (nme, 3, 6) array
+    """
+    ql = q[me]                 # (nme, 3, 2)
+    u = ql[:, 1] - ql[:, 2]
+    v = ql[:, 2] - ql[:, 0]
+    w = ql[:, 0] - ql[:, 1]
+
+    B = np.zeros((me.shape[0], 3, 6))
+    B[:, 0, 0::2] = np.stack([u[:, 1], v[:, 1], w[:, 1]], axis=1)
+    B[:, 1, 1::2] = -np.stack([u[:, 0], v[:, 0], w[:, 0]], axis=1)
+    B[:, 2, 0::2] = -np.stack([u[:, 0], v[:, 0], w[:, 0]], axis=1)
+    B[:, 2, 1::2] = np.stack([u[:, 1], v[:, 1], w[:, 1]], axis=1)
+    return B
+
+def ElemStiffElasMatBa2DP1_vec(q, me, areas, C, B=None):
+    """ Batched version of :func:`ElemStiffElasMatBa2DP1`,
+    returns the element stiffness matrices of the whole mesh as (nme, 6, 6) array.
+    B are the matrices of :func:`ElemStrainMatBa2DP1_vec` if already computed.
+    """
+    if B is None:
+        B = ElemStrainMatBa2DP1_vec(q, me)
+    return np.einsum('eki,kl,elj->eij', B, C, B, optimize=True)/(4*areas[:, None, None])
+
+def GetI2DP1_vec(me):
+    """ Batched version of GetI2DP1, returns (nme, 6) array of element dofs."""
+    edof = np.empty((me.shape[0], 6), dtype=int)
+    edof[:, 0::2] = 2*me
+    edof[:, 1::2] = 2*me+1
+    return edof
+
 GetI2DP1 = BuildIkFunc0()
 
+# upper bound of the temporaries of the element assembly per element (bytes)
+ASSEMBLY_BYTES_PER_ELEMENT = 2048
+
+# columns of A^-1 solved to measure their cost before the first low-rank update
+LOW_RANK_PROBE_COLUMNS = 8
+
 class TopOptimizer2D:
     def __init__(self, method_dict, args, activate_method = True) -> None:
         
@@ -65,7 +116,54 @@ class TopOptimizer2D:
 
         self.problem_args = problem_list[self.problem_name]
 
-        self.Th = LoadedMesh2D(f'../{self.problem_args["meshfile"]}')
+        # optional node renumbering ("rcm", "mmd") for the sparse factorization
+        renumbering = args.get("node_renumbering", None)
+
+        # "compact": element matrices are stored as shape function gradients
+        # (CompactElements) and dofs as int32, assembled by chunks of elements
+        # or applied by the matrix-free operator (the default of matrix_free)
+        matrix_free = args.get("matrix_free", False) and not args.get("structured_mesh", False)
+        self.element_storage = args.get("element_storage", "compact" if matrix_free else "full")
+        if self.element_storage not in ["full", "compact"]:
+            raise ValueError(f"Unknown element_storage '{self.element_storage}'")
+        if self.element_storage == "compact" and args.get("structured_mesh", False):
+            raise ValueError("element_storage 'compact' is not supported with structured_mesh")
+
+        # out-of-core mode: mesh and element arrays live in one memory-mapped
+        # file, which is reused (and shared) by runs with the same mesh
+        self.element_bundle = args.get("element_bundle", None)
+        self.bundle_writer = None
+        self.stored_elements = None
+        if self.element_bundle is not None:
+            if any(args.get(key, False) for key in ["symmetry", "structured_mesh", "matrix_free", "void_elimination"]):
+                raise ValueError("element_bundle needs the assembled general path (no symmetry, structured_mesh, matrix_free or void_elimination)")
+            meshfile = f'../{self.problem_args["meshfile"]}'
+            self.bundle_key = {"meshfile": self.problem_args["meshfile"], "mesh_mtime": os.path.getmtime(meshfile),
+                               "renumbering": renumbering, "element_storage": self.element_storage}
+            self.stored_elements = self.open_element_bundle()
+
+        self.symmetry = None
+        self.symmetry_meta = None
+        if args.get("symmetry", False):
+            # solve mirror-symmetric problems on a half mesh, results are mapped back to Th_full
+            self.Th_full = LoadedMesh2D(f'../{self.problem_args["meshfile"]}')
+            self.symmetry = find_mirror_symmetry(self.Th_full, self.problem_args)
+        if self.symmetry is not None:
+            self.Th = self.symmetry.half_mesh(renumbering)
+            self.problem_args = self.symmetry.half_problem(self.problem_args)
+            self.symmetry_meta = {"axis": self.symmetry.axis, "c": float(self.symmetry.c),
+                                  "pin": None if self.symmetry.pin is None else self.symmetry.pin.tolist(),
+                                  "full_elements": int(self.Th_full.me.shape[0]),
+                                  "half_elements": int(self.Th.me.shape[0])}
+            print("Mirror symmetry: ", self.symmetry_meta)
+        elif self.stored_elements is not None:
+            arrays, meta = self.stored_elements
+            self.Th = LoadedMesh2D.from_geometry(arrays["q"], arrays["me"], arrays["areas"], arrays["centroids"],
+                                                 arrays["node_permutation"], meta["renumbering_report"])
+            self.Th_full = self.Th
+        else:
+            self.Th = LoadedMesh2D(f'../{self.problem_args["meshfile"]}', renumbering=renumbering)
+            self.Th_full = self.Th
 
         # to save indeces and K_e for assembling global stiffness matrix
         self.ik = []
@@ -80,20 +178,72 @@ class TopOptimizer2D:
 
         self.nme = self.Th.me.shape[0]   # number of elements
         self.ndof = 2*self.Th.q.shape[0] # number of degrees of freedoms
+        self.dof_dtype = np.int32 if self.element_storage == "compact" and self.ndof < np.iinfo(np.int32).max else int
+
+        # "float32": single precision factorization with iterative refinement,
+        # element compliances are handed to the methods in single precision
+        self.fem_precision = args.get("fem_precision", "float64")
 
-        self.u = np.zeros((self.ndof,))  # vector of displacments
-        self.f = np.zeros((self.ndof,))  # vector of loads
-        self.ce = np.ones(self.Th.me.shape[0]) # vector of compliances
+        self.ce = np.ones(self.Th.me.shape[0], dtype=self.fem_precision) # vector of compliances
+
+        # per-element strain energy densities for feature-mapping methods
+        self.store_sed = args.get("strain_energy_density", False)
+        self.sed = np.zeros(self.Th.me.shape[0], dtype=self.fem_precision)
 
         # get Hooke matrix
         la = 1.5
         mu = 0.5
         self.C=Hooke2DP1(la,mu)
 
+        # matrix-free mode: K is applied element by element (no triplets,
+        # no assembled or factorized matrix), solved with CG
+        self.matrix_free = args.get("matrix_free", False)
+
+        # structured meshes: only one stiffness block per element type is
+        # stored (K_sep[element_types[e]]), solved matrix-free
+        self.structured_mesh = args.get("structured_mesh", False)
+        self.max_element_types = args.get("max_element_types", 8)
+        self.element_types = None
+        self.grid = None
+
+        # strains/stresses of all elements in the iteration log, rounded to
+        # stress_log_digits significant digits; the strain matrices B of the
+        # assembly are kept for it (per element type on structured meshes)
+        self.stress_log = args.get("stress_log", False)
+        self.stress_log_digits = args.get("stress_log_digits", 4)
+        self.B = None
+
+        # chunked element assembly: number of threads and memory ceiling (bytes)
+        # for the temporaries of the chunks processed at the same time, serial
+        # by default (no measured multi-core speedup of the threaded chunks yet)
+        self.assembly_workers = args.get("assembly_workers", 1)
+        self.assembly_memory = args.get("assembly_memory", 256e6)
+        # element blocks of the streamed passes over memory-mapped or compact
+        # element data, K is then assembled by blocks of elements
+        self.element_blocks = element_chunks(self.nme, ASSEMBLY_BYTES_PER_ELEMENT, self.assembly_memory)
+        self.streamed_assembly = self.element_bundle is not None or self.element_storage == "compact"
+
         self.build_stiffness_matrix()
         self.build_constraints()
         self.apply_loads()
 
+        # objective on the displacements: "compliance" or "displacement",
+        # l^T u with the vector l given by "output_loads" of the problem
+        # (e.g. the output port of a compliant mechanism)
+        self.objective = args.get("objective", "compliance")
+        if self.objective == "displacement":
+            if self.n_cases > 1 and self.load_aggregation == "max":
+                raise ValueError("'displacement' objective supports only the 'sum' load aggregation")
+            self.output_vector = self.load_vector(self.problem_args["output_loads"])
+        elif self.objective != "compliance":
+            raise ValueError(f"Unknown objective '{self.objective}'")
+
+        # displacements and element compliances for every load case,
+        # self.u is the displacement of the first one
+        self.U = np.zeros((self.ndof, self.n_cases))
+        self.u = self.U[:, 0]
+        self.ce_cases = np.ones((self.n_cases, self.nme), dtype=self.fem_precision)
+
         # update initial conditions
         self.dofs = np.arange(self.ndof)
 
@@ -103,12 +253,60 @@ class TopOptimizer2D:
         self.free_dof = np.setdiff1d(self.dofs, self.fixed_dof)
         self.free_dof = np.setdiff1d(self.free_dof, self.moved_dof)
 
-        self.jk = np.array(self.jk)
-        self.ik = np.array(self.ik)
-        self.iK = self.ik.flatten()
-        self.jK = self.jk.flatten()
-        self.edof = np.array(self.edof, dtype=int)
-        self.K_sep = np.array(self.K_sep)
+        if self.matrix_free:
+            self.build_operators()
+        else:
+            self.iK = self.ik.ravel()
+            self.jK = self.jk.ravel()
+            if self.streamed_assembly:
+                self.build_element_pattern()
+            self.build_assembly()
+
+        # linear solver backend for the FEM system, selected by args["solver"]
+        self.solver = get_solver(args, default=self.default_solver())
+        if self.matrix_free and not self.solver.matrix_free:
+            raise ValueError("matrix_free requires a CG solver with 'jacobi' or 'chebyshev' preconditioner")
+        if self.fem_precision != "float64":
+            if not self.solver.mixed_precision:
+                raise ValueError(f"fem_precision '{self.fem_precision}' requires a direct solver ('splu' or 'dense')")
+            self.solver.precision = self.fem_precision
+        self.near_nullspace_free = rigid_body_modes(self.Th.q)[self.free_dof]
+        self.solver.near_nullspace = self.near_nullspace_free
+        if getattr(self.solver, "preconditioner", None) == "gmg":
+            self.solver.prolongations = self.build_mesh_hierarchy(args.get("mg_coarse_nodes", 500))
+
+        # optional elimination of dofs in void regions, an approximation: void
+        # elements are solved as E = 0 instead of Emin (see solve_free_eliminated)
+        self.void_elimination = args.get("void_elimination", False)
+        # oc() keeps densities >= 1e-3, the default threshold has to lie above that floor
+        self.void_threshold = args.get("void_threshold", 1.5e-3)
+        # CG steps extending the solution into the eliminated void region
+        self.void_extension_steps = args.get("void_extension_steps", 20)
+        if self.void_elimination:
+            nq = self.Th.q.shape[0]
+            self.node_elements = sparse.csr_matrix((np.ones(3*self.nme), (self.Th.me.ravel(), np.repeat(np.arange(self.nme), 3))),
+                                                   shape=(nq, self.nme))
+
+        # optional low-rank (Woodbury) update of the last factorization when
+        # only a small fraction of the element stiffnesses changed
+        self.low_rank_update = args.get("low_rank_update", False)
+        self.low_rank_threshold = args.get("low_rank_threshold", 0.01)
+        # time of one column of A^-1, measured on the block solves (None until the first one)
+        self.column_time = None
+        # how often the low-rank path replaced a factorization
+        self.low_rank_counts = {"updates": 0, "attempts": 0}
+        self.free_dof_map = dof_renumbering(self.free_dof, self.ndof)
+        self.reset_low_rank()
+
+        # densities of the matrix held by the solver (None if it holds another system)
+        self.factorized_x = None
+        if self.void_elimination and self.solver.prolongations is not None:
+            raise ValueError("void_elimination changes the system size, not supported with the 'gmg' preconditioner")
+        if self.matrix_free and (self.void_elimination or self.low_rank_update):
+            raise ValueError("void_elimination and low_rank_update need the assembled matrix, not matrix_free")
+
+        # per iteration statistics of the FEM core for the log
+        self.fem_meta = {}
 
         #for SIMP type methods
         self.penal = args["penal"]
@@ -122,7 +320,8 @@ class TopOptimizer2D:
                             "args": args,
                             "problem_config": self.problem_args,
                             "Emin": self.Emin,
-                            "Emax": self.Emax}
+                            "Emax": self.Emax,
+                            "fem": TorchFEM(self)}
 
             self.method = method_dict[args['method']](self.meth_args)
 
@@ -131,6 +330,8 @@ class TopOptimizer2D:
         meta = {
             'args': args,
             'problem': self.problem_args,
+            'renumbering': self.Th.renumbering_report,
+            'symmetry': self.symmetry_meta,
             'data': time.strftime("%Y-%m-%d"),
             'time': time.strftime("%H:%M:%S", time.localtime()),
             'iter_meta': {}
@@ -147,38 +348,191 @@ class TopOptimizer2D:
         self.K_free_to_invest = None
 
     def build_stiffness_matrix(self):
-        # create the elasticity problem
-        for k in tqdm(range(self.Th.me.shape[0])): # iterate each element
-            # get stiffness matrix for element
-            E=ElemStiffElasMatBa2DP1(self.Th.q[self.Th.me[k]],self.Th.areas[k], self.C)
-
-            # get indeces of degrees of freedoms for the element
-            I=GetI2DP1(self.Th.me,k)
-
-            # to save indeces and K_e separately  
-            ik_e = []
-            jk_e = []
-            K_e = []
-            edof_e = []
-
-            # iterate elements in K_e to save them and their global indeces
-            # of dofs to assembly global stiffness matrix
-            for il in range(0,6):
-                i=I[il]
-                edof_e.append(i)
-
-                for jl in range(0,6):
-                    j=I[jl]
-                        
-                    ik_e.append(i)
-                    jk_e.append(j)
-                    K_e.append(E[il,jl])
-
-            # save elements of global stiffness matrix in separted form
-            self.ik.append(ik_e)
-            self.jk.append(jk_e)
-            self.K_sep.append(K_e)
-            self.edof.append(edof_e)
+        if self.stored_elements is not None:
+            arrays, _ = self.stored_elements
+            self.edof, self.ik, self.jk = arrays["edof"], arrays["ik"], arrays["jk"]
+            if self.element_storage == "compact":
+                self.K_sep = CompactElements(arrays["gradients"], arrays["areas"], self.C)
+            else:
+                self.K_sep = arrays["K_sep"]
+            return
+        if self.element_bundle is not None:
+            # move the mesh into a new bundle, the element arrays are written there
+            self.bundle_writer = ElementBundle(self.element_bundle)
+            for name in ["q", "me", "areas", "centroids", "node_permutation"]:
+                setattr(self.Th, name, self.bundle_writer.add(name, None, data=getattr(self.Th, name)))
+
+        # get indeces of degrees of freedoms for the elements
+        self.edof = self.allocate_elements("edof", (self.nme, 6), self.dof_dtype)
+
+        if self.structured_mesh:
+            self.detect_structured_mesh()
+
+        # the element arrays are preallocated and filled by blocks of elements
+        # in a thread pool, temporaries stay below assembly_memory bytes
+        general = self.element_types is None
+        compact = self.element_storage == "compact"
+        if compact:
+            gradients = self.allocate_elements("gradients", (self.nme, 6))
+            self.K_sep = CompactElements(gradients, self.Th.areas, self.C)
+        elif general:
+            # save elements of global stiffness matrix in separted form,
+            # entry il*6+jl of each row corresponds to E[il, jl] with global indeces I[il], I[jl]
+            self.K_sep = self.allocate_elements("K_sep", (self.nme, 36))
+            if self.stress_log:
+                self.B = np.empty((self.nme, 3, 6))
+        if self.matrix_free:
+            self.ik = None
+            self.jk = None
+        else:
+            self.ik = self.allocate_elements("ik", (self.nme, 36), self.dof_dtype)
+            self.jk = self.allocate_elements("jk", (self.nme, 36), self.dof_dtype)
+
+        def assemble_chunk(chunk):
+            I = GetI2DP1_vec(self.Th.me[chunk])
+            self.edof[chunk] = I
+            if compact:
+                # shape function gradients are the entries of B/(2A)
+                B = ElemStrainMatBa2DP1_vec(self.Th.q, self.Th.me[chunk])
+                gradients[chunk] = np.concatenate((B[:, 0, 0::2], B[:, 1, 1::2]), axis=1)/(2*self.Th.areas[chunk, None])
+            elif general:
+                # create the elasticity problem for all elements of the chunk at once
+                me = self.Th.me[chunk]
+                B = ElemStrainMatBa2DP1_vec(self.Th.q, me)
+                self.K_sep[chunk] = ElemStiffElasMatBa2DP1_vec(self.Th.q, me, self.Th.areas[chunk], self.C, B).reshape(-1, 36)
+                if self.stress_log:
+                    self.B[chunk] = B/(2*self.Th.areas[chunk, None, None])
+            if not self.matrix_free:
+                self.ik[chunk].reshape(-1, 6, 6)[:] = I[:, :, None]
+                self.jk[chunk].reshape(-1, 6, 6)[:] = I[:, None, :]
+
+        chunks = element_chunks(self.nme, ASSEMBLY_BYTES_PER_ELEMENT, self.assembly_memory, self.assembly_workers)
+        if self.assembly_workers == 1 or len(chunks) == 1:
+            for chunk in chunks:
+                assemble_chunk(chunk)
+        else:
+            with ThreadPoolExecutor(self.assembly_workers) as pool:
+                list(pool.map(assemble_chunk, chunks))
+
+    def allocate_elements(self, name, shape, dtype=float):
+        # element arrays are allocated in the bundle in out-of-core mode
+        if self.bundle_writer is None:
+            return np.empty(shape, dtype=dtype)
+        return self.bundle_writer.add(name, shape, dtype)
+
+    def open_element_bundle(self):
+        # (arrays, meta) of an existing bundle built for the same mesh, else None
+        if not os.path.exists(self.element_bundle):
+            return None
+        arrays, meta = load_bundle(self.element_bundle)
+        if meta["key"] != self.bundle_key:
+            print(f"Element bundle {self.element_bundle} is outdated, rebuild")
+            return None
+        print(f"Element data memory-mapped from {self.element_bundle}")
+        return arrays, meta
+
+    def build_element_pattern(self):
+        # assembly plan of the full K for the streamed assembly, in out-of-core
+        # mode it is stored in the bundle (slots of the triplets and CSC
+        # pattern), which is completed here
+        shape = (self.ndof, self.ndof)
+        if self.stored_elements is not None:
+            arrays, _ = self.stored_elements
+            self.assembler = CSCAssembler.from_pattern(arrays["slots"], arrays["indices"], arrays["indptr"], shape)
+            return
+
+        triplet_chunks = [slice(36*chunk.start, 36*chunk.stop) for chunk in self.element_blocks]
+        # slots are at most the number of triplets
+        slots_dtype = np.int32 if self.iK.shape[0] < np.iinfo(np.int32).max else np.int64
+        slots = self.allocate_elements("slots", self.iK.shape, slots_dtype)
+        self.assembler = CSCAssembler(self.iK, self.jK, shape, chunks=triplet_chunks, slots=slots)
+        if self.bundle_writer is None:
+            # compact storage: the triplet indices are not needed anymore
+            self.ik = self.jk = self.iK = self.jK = None
+            return
+        self.bundle_writer.add("indices", None, data=self.assembler.K.indices)
+        self.bundle_writer.add("indptr", None, data=self.assembler.K.indptr)
+        arrays, meta = self.bundle_writer.close({"key": self.bundle_key, "renumbering_report": self.Th.renumbering_report})
+        self.bundle_writer = None
+
+        # continue on the read-only bundle
+        self.stored_elements = (arrays, meta)
+        for name in ["q", "me", "areas", "centroids", "node_permutation"]:
+            setattr(self.Th, name, arrays[name])
+        self.build_stiffness_matrix()
+        self.iK = self.ik.ravel()
+        self.jK = self.jk.ravel()
+        self.assembler.slots = arrays["slots"]
+        print(f"Element data written to {self.element_bundle}")
+
+    def default_solver(self):
+        # solver backend if args["solver"] is not given
+        return "cg_chebyshev" if self.matrix_free else "splu"
+
+    def build_assembly(self):
+        if self.streamed_assembly:
+            # blocks of the streamed assembly of the full K
+            self.free_block = CSCSubmatrix(self.assembler.K, self.free_dof, self.free_dof)
+            self.coupling_block = CSCSubmatrix(self.assembler.K, self.free_dof, self.moved_fixed_dof)
+            return
+        # assembly plans for the reduced system: K_free = K[free, free] and
+        # the Dirichlet coupling block K[free, moved_fixed]
+        self.free_assembler = CSCAssembler(self.iK, self.jK, (self.ndof, self.ndof),
+                                           rows=self.free_dof, cols=self.free_dof)
+        self.coupling_assembler = CSCAssembler(self.iK, self.jK, (self.ndof, self.ndof),
+                                               rows=self.free_dof, cols=self.moved_fixed_dof)
+
+    def detect_structured_mesh(self):
+        # regular triangulations have a few element types (shape and orientation),
+        # in that case K_sep holds the (ntypes, 36) reference blocks. Lattices
+        # with the same split of every cell are applied as stencils on the node
+        # grid (see structured_grid), other meshes group the elements by type
+        element_types, representatives = classify_elements(self.Th.q, self.Th.me)
+        if representatives.shape[0] > self.max_element_types:
+            print(f"Mesh is not structured ({representatives.shape[0]} element types), general path")
+            self.structured_mesh = False
+            return
+
+        self.element_types = element_types
+        me_ref = self.Th.me[representatives]
+        B_ref = ElemStrainMatBa2DP1_vec(self.Th.q, me_ref)
+        self.K_sep = ElemStiffElasMatBa2DP1_vec(self.Th.q, me_ref, self.Th.areas[representatives], self.C, B_ref).reshape(-1, 36)
+        if self.stress_log:
+            self.B = B_ref/(2*self.Th.areas[representatives, None, None])
+        self.matrix_free = True
+        self.grid = structured_grid(self.Th.q, self.Th.me, element_types)
+        layout = "grid stencils" if self.grid is not None else "grouped elements"
+        print(f"Structured mesh: {representatives.shape[0]} element types, {layout}")
+
+    def build_operators(self):
+        # matrix-free counterparts of build_assembly, the Dirichlet coupling
+        # is applied with the full operator on the prescribed displacements
+        if self.grid is not None:
+            self.operator = GridStiffnessOperator(*self.grid, self.K_sep, self.ndof)
+            self.free_operator = GridStiffnessOperator(*self.grid, self.K_sep, self.ndof, dofs=self.free_dof)
+            return
+        self.operator = ElementStiffnessOperator(self.edof, self.K_sep, self.ndof,
+                                                 element_types=self.element_types)
+        self.free_operator = ElementStiffnessOperator(self.edof, self.K_sep, self.ndof, dofs=self.free_dof,
+                                                      element_types=self.element_types)
+
+    def build_mesh_hierarchy(self, coarse_nodes=500):
+        """
+        Remeshes the geometry at coarser mesh sizes (see mesh_hierarchy) and
+        returns the prolongations between the levels for geometric multigrid,
+        from the free dofs of the mesh down to the coarsest mesh. Coarse dofs
+        which do not interpolate to any free dof are dropped.
+        """
+        print("Build mesh hierarchy ...")
+        prolongations = []
+        q_fine, rows = self.Th.q, self.free_dof
+        for q_coarse, me_coarse in mesh_hierarchy(self.Th.q, self.Th.me, coarse_nodes):
+            P = sparse.kron(interpolation_matrix(q_fine, q_coarse, me_coarse), sparse.eye(2)).tocsr()[rows]
+            cols = np.flatnonzero(np.asarray(abs(P).sum(0)).ravel() > 0)
+            prolongations.append(P[:, cols].tocsr())
+            print(f"level {len(prolongations)}: {q_coarse.shape[0]} nodes, {len(cols)} dofs")
+            q_fine, rows = q_coarse, cols
+        return prolongations
 
     def build_constraints(self):
         # split coords
@@ -189,20 +543,8 @@ class TopOptimizer2D:
             case_list = self.problem_args[fixed_case]
             for case in case_list:
                 
-                # x component
-                if isinstance(case[0], list):
-                    x_bids = np.logical_and(self.Th.q[:, 0] >= case[0][0], self.Th.q[:, 0] <= case[0][1])
-                else:
-                    x_bids = np.isclose(self.Th.q[:, 0], case[0])
-
-                # y component
-                if isinstance(case[1], list):
-                    y_bids = np.logical_and(self.Th.q[:, 1] >= case[1][0], self.Th.q[:, 1] <= case[1][1])
-                else:
-                    y_bids = np.isclose(self.Th.q[:, 1], case[1])
-
-                bc_bids = np.logical_and(x_bids, y_bids)
-                print("Fixed case: ", fixed_case, case, bc_bids.sum(), y_bids.sum())
+                bc_bids = select_nodes(self.Th.q, case[0], case[1])
+                print("Fixed case: ", fixed_case, case, bc_bids.sum())
                 node_ids = node_range[bc_bids]
 
                 for node_id in node_ids:
@@ -218,35 +560,312 @@ class TopOptimizer2D:
                         self.fixed_dof.append(2*node_id+1)
 
     def apply_loads(self):
-        node_range = np.arange(self.Th.q.shape[0])
-        load_list = self.problem_args["loads"]
-        for case in load_list:
-            # x component
-            if isinstance(case[0][0], list):
-                x_bids = np.logical_and(self.Th.q[:, 0] >= case[0][0][0], self.Th.q[:, 0] <= case[0][0][1])
-            else:
-                x_bids = np.isclose(self.Th.q[:, 0], case[0][0])
-
-            # y component
-            if isinstance(case[0][1], list):
-                y_bids = np.logical_and(self.Th.q[:, 1] >= case[0][1][0], self.Th.q[:, 1] <= case[0][1][1])
+        """
+        Builds the load vectors. A problem defines either a single "loads" list
+        or "load_cases": [{"loads": [...], "weight": w}, ...] which are solved
+        together and aggregated according to "load_aggregation" ("sum" or "max").
+        self.F holds one column per load case, self.f is the first one.
+        """
+        load_cases = self.problem_args.get("load_cases", [{"loads": self.problem_args["loads"]}])
+        self.n_cases = len(load_cases)
+        self.case_weights = np.array([case.get("weight", 1.0) for case in load_cases])
+        self.load_aggregation = self.problem_args.get("load_aggregation", "sum")
+
+        self.F = np.zeros((self.ndof, self.n_cases))
+        for case_id, load_case in enumerate(load_cases):
+            self.F[:, case_id] = self.load_vector(load_case["loads"])
+        self.f = self.F[:, 0]
+
+        print("Loaded loads: ", self.F[self.F != 0].shape, "load cases: ", self.n_cases)
+
+    def load_vector(self, load_list):
+        # nodal forces (nq, 2) flattened to dofs 2n, 2n+1
+        if self.symmetry is not None:
+            return self.symmetry.symmetric_loads(self.Th.q, load_list).ravel()
+        return nodal_loads(self.Th.q, load_list).ravel()
+
+    def solve_free(self, K_free, F_free, xPhys, sK):
+        """
+        Solves K_free U_free = F_free for all load cases, K_free is factorized
+        once and the load cases are solved as one block.
+        """
+        self.fem_meta = {}
+        self.factorized_x = None
+        if self.void_elimination:
+            U_free = self.solve_free_eliminated(K_free, F_free, xPhys, sK)
+            if U_free is not None:
+                # the solver now holds the reduced system
+                self.reset_low_rank()
+                return U_free
+
+        E = self.Emin + xPhys**self.penal*(self.Emax-self.Emin)
+        if self.low_rank_update and self.E_ref is not None:
+            U_free = self.solve_free_low_rank(K_free, F_free, E)
+            if U_free is not None:
+                return U_free
+
+        self.solver.near_nullspace = self.near_nullspace_free
+        self.solver.factorize(K_free)
+        self.factorized_x = xPhys.copy()
+        U_free = self.solver.solve(F_free, x0=self.U[self.free_dof])
+        if self.low_rank_update:
+            self.reset_low_rank(E)
+        return U_free
+
+    def reset_low_rank(self, E_ref=None):
+        # E_ref are the element stiffnesses of the factorized matrix, columns
+        # of its inverse computed for the updates are kept until the next
+        # factorization, inverse_pos maps free dofs to these columns
+        self.E_ref = None if E_ref is None else E_ref.copy()
+        self.inverse_pos = -np.ones(len(self.free_dof), dtype=np.int64)
+        self.inverse_cols = np.zeros((len(self.free_dof), 0))
+        # time spent on columns of A^-1 for this factorization
+        self.columns_spent = 0.0
+        if E_ref is not None:
+            self.factor_time = self.solver.stats["factor_time"]
+
+    def add_inverse_columns(self, dofs):
+        """Computes the columns A^-1[:, dofs] of the factorized reference matrix A as one block solve."""
+        P = np.zeros((len(self.free_dof), dofs.shape[0]))
+        P[dofs, np.arange(dofs.shape[0])] = 1
+        start = time.perf_counter()
+        columns = self.solver.solve(P)
+        elapsed = time.perf_counter() - start
+        self.column_time = elapsed/dofs.shape[0]
+        self.columns_spent += elapsed
+        self.inverse_pos[dofs] = self.inverse_cols.shape[1] + np.arange(dofs.shape[0])
+        self.inverse_cols = np.hstack((self.inverse_cols, columns))
+
+    def solve_free_low_rank(self, K_free, F_free, E):
+        """
+        Low-rank re-solve: K_free = A + P D P^T, where A is the last factorized
+        matrix and D the stiffness change of the elements whose E changed since,
+        on the dofs P. With Woodbury's identity
+
+            U = A^-1 F - A^-1 P (I + D P^T A^-1 P)^-1 D P^T A^-1 F
+
+        only solves with the existing factorization are needed (meant for the
+        direct backends, columns of A^-1 are cached until the next full
+        factorization and computed as one block solve). Returns None (full
+        solve) if more than low_rank_threshold of the elements changed, the
+        columns of A^-1 computed since the factorization would cost more than
+        the factorization (timed on the block solves), or the corrected
+        solution fails the residual check.
+
+        It pays off when only a few elements change between iterations
+        (local or discrete design updates, the last iterations of a
+        converging run). OC/MMA updates move almost every density in the
+        early iterations, those always take the full solve; fem_meta
+        ["low_rank"] counts how often the update engaged.
+        """
+        dE = E - self.E_ref
+        changed = np.flatnonzero(dE)
+        fraction = changed.shape[0]/self.nme
+        self.low_rank_counts["attempts"] += 1
+        self.fem_meta["low_rank"] = {"changed_elements": int(changed.shape[0]),
+                                     "fraction": fraction, "rank": 0, "fallback": True, **self.low_rank_counts}
+        if fraction > self.low_rank_threshold:
+            return None
+
+        dofs, D = stiffness_update(self.edof, self.K_sep, dE, changed, self.free_dof_map)
+        new_dofs = dofs[self.inverse_pos[dofs] < 0]
+        if self.column_time is None and new_dofs.shape[0]:
+            # the cost of a column is measured on a small block first
+            self.add_inverse_columns(new_dofs[:LOW_RANK_PROBE_COLUMNS])
+            new_dofs = new_dofs[LOW_RANK_PROBE_COLUMNS:]
+        if self.columns_spent + new_dofs.shape[0]*self.column_time > self.factor_time:
+            return None
+
+        start = time.perf_counter()
+        if new_dofs.shape[0]:
+            self.add_inverse_columns(new_dofs)
+        U_free = self.solver.solve(F_free, x0=self.U[self.free_dof])
+        if dofs.shape[0]:
+            cols = self.inverse_pos[dofs]
+            S = np.eye(dofs.shape[0]) + D @ self.inverse_cols[dofs][:, cols]    # I + D P^T A^-1 P
+            W = np.zeros((self.inverse_cols.shape[1], F_free.shape[1]))
+            W[cols] = np.linalg.solve(S, D @ U_free[dofs])
+            U_free = U_free - self.inverse_cols @ W
+        self.fem_meta["low_rank"]["rank"] = int(dofs.shape[0])
+
+        residual = np.linalg.norm(F_free - K_free @ U_free)/max(np.linalg.norm(F_free), 1e-300)
+        if not residual < 1e-6:
+            print("Low-rank update rejected, residual", residual)
+            return None
+        self.fem_meta["low_rank"]["fallback"] = False
+        self.low_rank_counts["updates"] += 1
+        self.fem_meta["low_rank"].update(self.low_rank_counts)
+
+        print(f"Low-rank update: {changed.shape[0]} elements changed, rank {dofs.shape[0]}, {time.perf_counter() - start:.3f} s")
+        return U_free
+
+    def solve_free_eliminated(self, K_free, F_free, xPhys, sK):
+        """
+        Active-set dof elimination: elements with xPhys < void_threshold are
+        treated as true void (E = 0 instead of Emin), the dofs of nodes
+        surrounded only by void elements drop out of the solve, their
+        displacements are extended from the solid boundary (so that ce and
+        the sensitivities of void elements stay meaningful) by a few
+        Jacobi-preconditioned CG steps started from the previous u. Loaded
+        dofs are always kept.
+
+        This approximates the full solve: the Emin stiffness of the void
+        elements is dropped, which changes the objective slightly (0.05-0.2%
+        on optimized MBB designs).
+        Returns None (full solve) if nothing is eliminated or the reduced
+        system fails the safety checks.
+        """
+        # nodes touching at least one solid element stay in the system
+        solid = (xPhys >= self.void_threshold).astype(float)
+        active_nodes = self.node_elements @ solid > 0
+        active_dof = np.repeat(active_nodes, 2)
+        keep = active_dof[self.free_dof] | np.any(F_free != 0, axis=1)
+
+        n_eliminated = int((~keep).sum())
+        self.fem_meta["void_elimination"] = {"eliminated_dofs": n_eliminated,
+                                             "free_dofs": int(keep.shape[0]),
+                                             "reduction": n_eliminated/keep.shape[0],
+                                             "fallback": False}
+        if n_eliminated == 0:
+            return None
+        print(f"Void elimination: removed {n_eliminated} of {keep.shape[0]} free dofs ({100*n_eliminated/keep.shape[0]:.1f}%)")
+
+        # void elements are removed from the operator, otherwise the eliminated
+        # nodes would act as supports attached through Emin springs
+        if sK is None:
+            # streamed assembly (compact elements): the solid elements are
+            # scattered into a copy of the full K, K_free is the block of it
+            E = self.Emin + xPhys**self.penal*(self.Emax-self.Emin)
+            K = self.assembler.assemble_elements(self.K_sep, E*solid, self.element_blocks, K=self.assembler.K.copy())
+            K_solid = self.free_block.update(K, block=K_free.copy())
+        else:
+            K_solid = self.free_assembler.assemble(sK*np.repeat(solid, 36), K=K_free.copy())
+        K_active = K_solid[keep][:, keep].tocsc()
+        try:
+            if K_active.diagonal().min() <= 0:
+                raise RuntimeError("non-positive diagonal in the reduced system")
+            self.solver.near_nullspace = self.near_nullspace_free[keep]
+            self.solver.factorize(K_active)
+            U_active = self.solver.solve(F_free[keep], x0=self.U[self.free_dof][keep])
+            if not np.all(np.isfinite(U_active)) or self.solver.stats["residual"] > 1e-6:
+                raise RuntimeError(f"residual {self.solver.stats['residual']}")
+        except RuntimeError as e:
+            print("Void elimination: reduced system rejected, full solve.", e)
+            self.fem_meta["void_elimination"]["fallback"] = True
+            return None
+
+        U_free = np.zeros_like(F_free)
+        U_free[keep] = U_active
+
+        # the void region follows the solid boundary through its Emin
+        # stiffness, the feedback to the solid is neglected; a few CG steps
+        # instead of a second factorization, the previous u is a close start
+        void = ~keep
+        K_void = K_free[void]
+        A_void = K_void[:, void].tocsr()
+        M = sparse.diags(1/A_void.diagonal())
+        B_void = -(K_void[:, keep] @ U_active).reshape(-1, F_free.shape[1])
+        U_void = self.U[self.free_dof][void]
+        for case_id in range(F_free.shape[1]):
+            U_free[void, case_id], _ = sla.cg(A_void, B_void[:, case_id], x0=U_void[:, case_id], rtol=1e-8,
+                                             maxiter=self.void_extension_steps, M=M)
+
+        return U_free
+
+    def compute_compliance(self, xPhys):
+        # compliances of all elements at once for every load case, the objective
+        # is computed in double precision before storing with fem_precision
+        ce_cases = np.empty((self.n_cases, self.nme))
+        for case_id in range(self.n_cases):
+            ce_cases[case_id] = self.element_energies(self.U[:, case_id])
+        self.ce_cases[:] = ce_cases
+
+        E = self.Emin+xPhys**self.penal*(self.Emax-self.Emin)
+        self.obj_cases = ce_cases @ E
+
+        # aggregate load cases
+        if self.n_cases == 1:
+            ce = ce_cases[0]
+            self.obj = self.obj_cases[0]
+        elif self.load_aggregation == "max":
+            active_case = np.argmax(self.case_weights*self.obj_cases)
+            ce = self.case_weights[active_case]*ce_cases[active_case]
+            self.obj = self.case_weights[active_case]*self.obj_cases[active_case]
+        else:
+            ce = self.case_weights @ ce_cases
+            self.obj = self.case_weights @ self.obj_cases
+        self.ce[:] = ce
+
+        # strain energy densities 0.5 E_e u_e^T K_e u_e / A_e of the aggregated compliance
+        if self.store_sed:
+            self.sed[:] = 0.5*E*ce/self.Th.areas
+
+        if self.symmetry is not None:
+            self.fem_meta["symmetry"] = {"obj_full": float(2*self.obj)}
+
+    def element_energies(self, u, v=None):
+        # u_e^T K_e u_e (v_e^T K_e u_e) of all elements, memory-mapped
+        # element data is streamed by blocks of elements
+        if self.element_types is not None:
+            return self.operator.element_compliance(u, v=v)
+        if self.element_storage == "compact":
+            def kernel(chunk):
+                return self.K_sep.compliance(u, self.edof, v, elements=chunk)
+        else:
+            def kernel(chunk):
+                return element_compliance(u, self.edof[chunk], self.K_sep[chunk], v=v)
+        if self.element_bundle is None:
+            return kernel(slice(None))
+        ce = np.empty(self.nme)
+        for chunk in self.element_blocks:
+            ce[chunk] = kernel(chunk)
+        return ce
+
+    def strain_matrices(self):
+        # strain-displacement matrices eps_e = B_e u_e (per element type on structured meshes)
+        if self.B is None:
+            if self.element_types is None:
+                self.B = ElemStrainMatBa2DP1_vec(self.Th.q, self.Th.me)/(2*self.Th.areas[:, None, None])
             else:
-                y_bids = np.isclose(self.Th.q[:, 1], case[0][1])
-
-            bc_bids = np.logical_and(x_bids, y_bids)
-            node_ids = node_range[bc_bids]
-
-            self.f[node_ids*2] = case[1][0]
-            self.f[node_ids*2+1] = case[1][1]
-
-        print("Loaded loads: ", self.f[self.f != 0].shape)
+                representatives = np.unique(self.element_types, return_index=True)[1]
+                self.B = ElemStrainMatBa2DP1_vec(self.Th.q, self.Th.me[representatives])/(2*self.Th.areas[representatives, None, None])
+        return self.B
+
+    def compute_stresses(self, xPhys, u=None):
+        """
+        Strains (eps_xx, eps_yy, gamma_xy), stresses E_e C eps (SIMP stiffness)
+        and von Mises stresses of all elements for the displacements u (the
+        first load case by default). Returns (nme, 3), (nme, 3), (nme,) arrays.
+        """
+        u = self.u if u is None else u
+        if self.element_storage == "compact":
+            strain = self.K_sep.strains(u, self.edof)
+        else:
+            strain = element_strains(u, self.edof, self.strain_matrices(), self.element_types)
+        E = self.Emin+xPhys**self.penal*(self.Emax-self.Emin)
+        stress = E[:, None]*(strain @ self.C.T)
+        return strain, stress, von_mises(stress)
+
+    def log_stresses(self, xPhys):
+        # strain/stress fields of every load case at reduced precision
+        stress_meta = []
+        for case_id in range(self.n_cases):
+            strain, stress, vm = self.compute_stresses(xPhys, self.U[:, case_id])
+            stress_meta.append({"max_von_mises": float(vm.max()),
+                                "von_mises": round_significant(vm, self.stress_log_digits).tolist(),
+                                "strain": round_significant(strain, self.stress_log_digits).tolist(),
+                                "stress": round_significant(stress, self.stress_log_digits).tolist()})
+        self.fem_meta["stress"] = stress_meta
 
     def update_meth_args(self):
         self.meth_args["ce"] = self.ce
+        self.meth_args["ce_cases"] = self.ce_cases
+        if self.store_sed:
+            self.meth_args["sed"] = self.sed
 
     def log_meta(self):
         iteration = self.method.global_i
-        iteration_meta = self.method.meta
+        iteration_meta = {**self.method.meta, "solver": self.solver.stats, "fem": self.fem_meta}
 
         with open(self.log_file_name, 'r') as fp:
             meta = json.load(fp)
@@ -257,67 +876,162 @@ class TopOptimizer2D:
             json.dump(meta, fp)
 
     def save_data(self, directory):
-        np.save(f"{directory}/K_sep.npy", self.K_sep)
+        if self.element_bundle is not None:
+            # mesh and element arrays are in the bundle, linked (or copied) next to the data
+            try:
+                os.link(self.element_bundle, f"{directory}/elements.bundle")
+            except OSError:
+                shutil.copyfile(self.element_bundle, f"{directory}/elements.bundle")
+        elif self.element_storage == "compact":
+            np.save(f"{directory}/gradients.npy", self.K_sep.gradients)
+        else:
+            np.save(f"{directory}/K_sep.npy", self.K_sep)
+        if self.element_types is not None:
+            np.save(f"{directory}/element_types.npy", self.element_types)
         np.save(f"{directory}/free_dof.npy", self.free_dof)
         np.save(f"{directory}/moved_fixed_dof.npy", self.moved_fixed_dof)
         np.save(f"{directory}/f.npy", self.f)
-        np.save(f"{directory}/ik.npy", self.ik)
-        np.save(f"{directory}/jk.npy", self.jk)
+        if self.ik is not None and self.element_bundle is None:
+            np.save(f"{directory}/ik.npy", self.ik)
+            np.save(f"{directory}/jk.npy", self.jk)
+
+    def full_density(self, x):
+        # densities on the full mesh (mirrored from the half mesh for symmetric problems)
+        return x if self.symmetry is None else self.symmetry.mirror_density(x)
+
+    def full_displacement(self, u):
+        return u if self.symmetry is None else self.symmetry.mirror_displacement(u)
 
     def plot_final_result(self, geometry_features = None, filename=None):
-        self.Th.plot_topology(self.x, geometry_features, filename=filename)
+        if self.symmetry is not None:
+            # geometry features live on the half mesh
+            geometry_features = None
+        self.Th_full.plot_topology(self.full_density(self.x), geometry_features, filename=filename)
 
     def save_solution(self, directory):
-        np.save(f"{directory}/u.npy", self.u)
-        np.save(f"{directory}/x.npy", self.x)
+        # displacements in the node order of the mesh file (undo node_renumbering)
+        np.save(f"{directory}/u.npy", self.Th_full.to_loaded_order(self.full_displacement(self.u)))
+        np.save(f"{directory}/x.npy", self.full_density(self.x))
+        if self.symmetry is not None:
+            np.save(f"{directory}/u_half.npy", self.Th.to_loaded_order(self.u))
+            np.save(f"{directory}/x_half.npy", self.x)
     
-    def optimize(self):
-        self.log_meta()
-        counter = 0
-        while not self.method.stop_flag:
-            counter += 1
-            xPhys = self.method.get_x(self.meth_args)
-
+    def build_system(self, xPhys):
+        """
+        Returns the reduced system K_free, F_free (all load cases) for the
+        densities xPhys and the triplet values sK (None in matrix-free mode).
+        """
+        if self.matrix_free:
+            sK = None
+            E = self.Emin+(xPhys)**self.penal*(self.Emax-self.Emin)
+            self.operator.set_E(E)
+            self.free_operator.set_E(E)
+            K_free = self.free_operator
+
+            U_bc = np.zeros_like(self.U)
+            U_bc[self.moved_fixed_dof] = self.U[self.moved_fixed_dof]
+            F_free = self.F[self.free_dof] - self.operator.apply(U_bc)[self.free_dof]
+        elif self.streamed_assembly:
+            # K is assembled streaming over the memory-mapped or compact elements
+            sK = None
+            E = self.Emin+(xPhys)**self.penal*(self.Emax-self.Emin)
+            K = self.assembler.assemble_elements(self.K_sep, E, self.element_blocks)
+            K_free = self.free_block.update(K)
+            F_free = self.F[self.free_dof] - (self.coupling_block.update(K) @ self.U[self.moved_fixed_dof])
+        else:
             # build global stiffness matrix
             sK=(self.K_sep.T*(self.Emin+(xPhys)**self.penal*(self.Emax-self.Emin))).flatten(order='F')
             # print(sK.shape)
             # print(self.iK.shape)
             # print(self.ndof)
-            K = coo_matrix((sK,(self.iK,self.jK)),shape=(self.ndof,self.ndof)).tocsc()
+            K_free = self.free_assembler.assemble(sK)
+            K_coupling = self.coupling_assembler.assemble(sK)
 
-            # compute RHS
+            # compute RHS for all load cases
             # print("compute RHS")
-            # F_free = self.f[self.free_dof] - (K[self.free_dof,:][:,np.concatenate((self.moved_dof, self.fixed_dof)).astype(int)] @ self.u[np.concatenate((self.moved_dof, self.fixed_dof)).astype(int)])
-            F_free = self.f[self.free_dof] - (K[self.free_dof,:][:,self.moved_fixed_dof] @ self.u[self.moved_fixed_dof])
-            
-            K_free = K[self.free_dof,:][:,self.free_dof]
+            F_free = self.F[self.free_dof] - (K_coupling @ self.U[self.moved_fixed_dof])
+        return K_free, F_free, sK
+
+    def factorize(self, xPhys, K_free=None):
+        """Factorizes the reduced system for xPhys unless the solver already holds it."""
+        if self.factorized_x is not None and np.array_equal(xPhys, self.factorized_x):
+            return
+        if K_free is None:
+            K_free, _, _ = self.build_system(xPhys)
+        self.solver.near_nullspace = self.near_nullspace_free
+        self.solver.factorize(K_free)
+        self.factorized_x = xPhys.copy()
+        if self.low_rank_update:
+            self.reset_low_rank(self.Emin + xPhys**self.penal*(self.Emax-self.Emin))
+
+    def adjoint_sensitivities(self, xPhys, dJdU, U=None):
+        """
+        Adjoint sensitivities of an objective J(U) of the displacements U
+        (self.U by default) for the densities xPhys, dJdU is dJ/dU (ndof, n_cases).
+
+        Returns the ce-equivalent lambda_e^T K_e u_e summed over the load cases,
+        K lambda = dJ/dU, so that dJ/dxPhys = -penal xPhys^(penal-1) (Emax-Emin) ce
+        as for the compliance. Costs one solve with the current factorization.
+        """
+        U = self.U if U is None else U
+        self.factorize(xPhys)
+        Lam = np.zeros_like(U)
+        Lam[self.free_dof] = self.solver.solve(dJdU[self.free_dof])
+
+        ce = np.zeros(self.nme)
+        for case_id in range(U.shape[1]):
+            ce += self.element_energies(U[:, case_id], Lam[:, case_id])
+        return ce
+
+    def objective_gradient(self, U=None):
+        """dJ/dU (ndof, n_cases) of the "displacement" objective J = sum_k w_k l^T U[:, k]."""
+        weights = np.ones(self.n_cases) if self.n_cases == 1 else self.case_weights
+        return np.outer(self.output_vector, weights)
+
+    def compute_objective(self, xPhys):
+        # objectives other than the compliance: the methods get the adjoint
+        # sensitivities in place of the element compliances
+        dJdU = self.objective_gradient()
+        compliance = self.obj
+        self.obj = float((dJdU*self.U).sum())
+        self.ce[:] = self.adjoint_sensitivities(xPhys, dJdU)
+        self.fem_meta["objective"] = {"type": self.objective, "value": self.obj, "compliance": float(compliance)}
+
+    def optimize(self):
+        self.log_meta()
+        counter = 0
+        x_prev = None
+        while not self.method.stop_flag:
+            counter += 1
+            xPhys = self.method.get_x(self.meth_args)
+
+            K_free, F_free, sK = self.build_system(xPhys)
 
             # if counter == 30:
             #     self.F_free_to_invest = F_free.copy()
             #     self.K_free_to_invest = K_free.copy()
             #     break
 
-            # compute SLE
+            # compute SLE, iterative backends start from the previous displacements
             # print("compute SLE")
-            K_free = K_free.tocsc() #  Need CSR for SuperLU factorisation
-            lu = sla.splu(K_free)
-            self.u[self.free_dof] = lu.solve(F_free)
+            if x_prev is not None:
+                self.solver.update_tolerance(np.abs(xPhys - x_prev).max())
+            self.U[self.free_dof] = self.solve_free(K_free, F_free, xPhys, sK)
+            x_prev = xPhys
 
             # show displacement
             # self.Th.plot_displacement(self.u)
             # break
-            self.Th.plot_topology(xPhys)
+            self.Th_full.plot_topology(self.full_density(xPhys))
 
             # print("U max", self.u.max())
             # compute compliance vector
             # print("Compute compliance vecotor ...")
-            for i, (edof_e, K_e_flatten) in enumerate(zip(self.edof, self.K_sep)): # iterate each element
-                u_e = self.u[edof_e] # vector of displacements for the element
-                K_e = K_e_flatten.reshape(6, 6) # upload K_e
-                self.ce[i] = np.dot(np.dot(u_e.T, K_e), u_e) # compute compliance for the element
-
-            
-            self.obj=((self.Emin+xPhys**self.penal*(self.Emax-self.Emin))*self.ce).sum() # global compliance
+            self.compute_compliance(xPhys) # element compliances and global compliance
+            if self.objective != "compliance":
+                self.compute_objective(xPhys)
+            if self.stress_log:
+                self.log_stresses(xPhys)
             # print("Computer obj ...: ", self.obj)
 
             self.log_meta()
@@ -327,7 +1041,21 @@ class TopOptimizer2D:
                    
 class TopOptimizer2D_ADMM(TopOptimizer2D):
     def __init__(self, method_dict, args, activate_method = True) -> None:
+        if args.get("element_storage", "full") != "full":
+            raise ValueError("TopOptimizer2D_ADMM needs the full element storage")
+
+        # displacement update (gamma_1 K^T K + gamma_3 I) u = RHS: "assembled"
+        # forms K^T K and factorizes it, "operator" solves with CG on the
+        # operator gamma_1 K^T (K v) + gamma_3 v (see NormalEquationsOperator),
+        # warm-started from the previous u
+        self.admm_update = args.get("admm_update", "assembled")
+        if self.admm_update not in ["assembled", "operator"]:
+            raise ValueError(f"Unknown admm_update '{self.admm_update}'")
         super().__init__(method_dict, args, activate_method)
+        if self.admm_update == "operator" and not self.solver.matrix_free:
+            raise ValueError("admm_update 'operator' requires a CG solver with 'jacobi' or 'chebyshev' preconditioner")
+        if self.matrix_free:
+            raise ValueError("matrix_free is not supported by TopOptimizer2D_ADMM")
 
         self.gamma_1 = args["gamma_1"]
         self.gamma_2 = args["gamma_2"]
@@ -336,7 +1064,7 @@ class TopOptimizer2D_ADMM(TopOptimizer2D):
         self.w = np.zeros((self.ndof,))  # vector of displacments
         self.tilde_mu = np.zeros((self.ndof,))  # vector of displacments
 
-        self.gamma_3_I = self.gamma_3 * sparse.eye(self.ndof)
+        self.gamma_3_I_free = self.gamma_3 * sparse.eye(len(self.free_dof))
 
         # self.K_sep_torch = torch.tensor(self.K_sep)
         # self.indeces_K_torch = torch.tensor([self.iK, self.jK])
@@ -355,6 +1083,17 @@ class TopOptimizer2D_ADMM(TopOptimizer2D):
 
         self.method = method_dict[args['method']](self.meth_args)
 
+    def build_assembly(self):
+        # column blocks K[:, free] and K[:, moved_fixed] are enough to form
+        # the reduced ADMM system, the full K is never assembled
+        self.free_assembler = CSCAssembler(self.iK, self.jK, (self.ndof, self.ndof),
+                                           cols=self.free_dof)
+        self.coupling_assembler = CSCAssembler(self.iK, self.jK, (self.ndof, self.ndof),
+                                               cols=self.moved_fixed_dof)
+
+    def default_solver(self):
+        return "cg_jacobi_warm" if self.admm_update == "operator" else super().default_solver()
+
     def update_meth_args(self):
         self.meth_args["ce"] = self.ce
         self.meth_args["u"] = self.u
@@ -366,21 +1105,26 @@ class TopOptimizer2D_ADMM(TopOptimizer2D):
         while not self.method.stop_flag:
             # update u
             sK=(self.K_sep.T*(self.Emin+(xPhys)**self.penal*(self.Emax-self.Emin))).flatten(order='F')
-            K = coo_matrix((sK,(self.iK,self.jK)),shape=(self.ndof,self.ndof)).tocsc()
+            K_free_cols = self.free_assembler.assemble(sK)             # K[:, free]
+            K_coupling_cols = self.coupling_assembler.assemble(sK)     # K[:, moved_fixed]
 
-            A = self.gamma_1*(K.T @ K) + self.gamma_3_I
+            # A = gamma_1*K.T@K + gamma_3*I restricted to the free dofs
+            if self.admm_update == "operator":
+                A_free = NormalEquationsOperator(K_free_cols, self.gamma_1, self.gamma_3)
+                A_coupling_u = self.gamma_1*(K_free_cols.T @ (K_coupling_cols @ self.u[self.moved_fixed_dof]))
+            else:
+                A_free = (self.gamma_1*(K_free_cols.T @ K_free_cols) + self.gamma_3_I_free).tocsc()
+                A_coupling_u = self.gamma_1*(K_free_cols.T @ K_coupling_cols) @ self.u[self.moved_fixed_dof]
             # print("A: ", A.shape)
             # print("K: ", K.shape)
             # print("self.w: ", self.w.shape)
             # print("self.tilde_mu: ", self.tilde_mu.shape)
-            RHS = self.gamma_2*(K.T @ self.f) + self.gamma_3*(self.w - self.tilde_mu)
+            RHS_free = self.gamma_2*(K_free_cols.T @ self.f) + self.gamma_3*(self.w - self.tilde_mu)[self.free_dof]
 
-            RHS_free = RHS[self.free_dof] - (A[self.free_dof,:][:,self.moved_fixed_dof] @ self.u[self.moved_fixed_dof])            
-            A_free = A[self.free_dof,:][:,self.free_dof]
+            RHS_free = RHS_free - A_coupling_u
 
-            A_free = A_free.tocsc() #  Need CSR for SuperLU factorisation
-            lu = sla.splu(A_free)
-            self.u[self.free_dof] = lu.solve(RHS_free)
+            self.solver.factorize(A_free)
+            self.u[self.free_dof] = self.solver.solve(RHS_free, x0=self.u[self.free_dof])
 
             # update xPhys
             self.update_meth_args()
@@ -392,36 +1136,34 @@ class TopOptimizer2D_ADMM(TopOptimizer2D):
             # update tilde_mu
             self.tilde_mu = self.tilde_mu + self.gamma_3*(self.u - self.w)
 
-            self.Th.plot_topology(xPhys)
+            self.Th_full.plot_topology(self.full_density(xPhys))
             self.log_meta()
             
 class TopOptimizer2D_LP(TopOptimizer2D):
     def __init__(self, method_dict, args, activate_method = True) -> None:
         super().__init__(method_dict, args, activate_method)
+        if self.matrix_free:
+            raise ValueError("matrix_free is not supported by TopOptimizer2D_LP")
 
         self.volumes = self.Th.areas
         self.assemble_t()
 
     def assemble_t(self):
-        t_list = []
-        for k in tqdm(range(self.nme), desc="Assembling t"):
-            sk=self.K_sep[k].T.flatten(order='F')
-            # print(sK.shape)
-            # print(self.iK.shape)
-            # print(self.ndof)
-            K = coo_matrix((sk,(self.ik[k],self.jk[k])),shape=(self.ndof,self.ndof)).tocsc()
-
-            # compute RHS
-            # print("compute RHS")
-            # F_free = self.f[self.free_dof] - (K[self.free_dof,:][:,np.concatenate((self.moved_dof, self.fixed_dof)).astype(int)] @ self.u[np.concatenate((self.moved_dof, self.fixed_dof)).astype(int)])
-            F_free = self.f[self.free_dof] - (K[self.free_dof,:][:,self.moved_fixed_dof] @ self.u[self.moved_fixed_dof])
-            K_free = K[self.free_dof,:][:,self.free_dof]
-
-            t = F_free.T @ K_free.T @ F_free
-
-            t_list.append(t)
-
-        self.t = np.array(t_list)
+        # t_e = F_e^T K_e^T F_e for the element stiffness K_e alone: F_e = f - K_e u
+        # on the free dofs with the prescribed displacements u, nonzero products
+        # only involve the 6 dofs of the element, all elements at once (by blocks)
+        is_free = np.zeros(self.ndof, dtype=bool)
+        is_free[self.free_dof] = True
+        is_prescribed = np.zeros(self.ndof, dtype=bool)
+        is_prescribed[self.moved_fixed_dof] = True
+
+        self.t = np.empty(self.nme)
+        for chunk in self.element_blocks:
+            edof = self.edof[chunk]
+            Ke = self.K_sep[chunk].reshape(-1, 6, 6)
+            u_prescribed = np.where(is_prescribed[edof], self.u[edof], 0.0)
+            F_e = np.where(is_free[edof], self.f[edof] - np.einsum('eij,ej->ei', Ke, u_prescribed), 0.0)
+            self.t[chunk] = np.einsum('ei,eji,ej->e', F_e, Ke, F_e)
 
         
 def oc(nme,x, v, vol_goal,dc,dv,g):
@@ -437,7 +1179,8 @@ def oc(nme,x, v, vol_goal,dc,dv,g):
     while (l2-l1)/(l1+l2)>1e-3:
         lmid=0.5*(l2+l1)
         # print(lmid)
-        xnew= np.maximum(0.001,np.maximum(x-move,np.minimum(1.0,np.minimum(x+move,x*np.sqrt(-dc/dv/lmid)))))
+        # positive sensitivities (non-compliance objectives) are clipped
+        xnew= np.maximum(0.001,np.maximum(x-move,np.minimum(1.0,np.minimum(x+move,x*np.sqrt(np.maximum(1e-10, -dc/dv/lmid))))))
 
         # gt=g+np.sum((dv*(xnew-x)))
         gt = np.sum(xnew * v) - vol_goal
@@ -448,36 +1191,36 @@ def oc(nme,x, v, vol_goal,dc,dv,g):
             l2=lmid
     return xnew, gt
 
-def filter_matrix(points, rmin):
-
-  x_array = points[:, 0]
-  y_array = points[:, 1]
-
-  indeces = np.arange(points.shape[0])
-    
-  # H = sparse.csr_matrix((points.shape[0], points.shape[0]))
-  H = sparse.lil_matrix((points.shape[0], points.shape[0]))
-  print("Build filter matrix ...")
-  for i, point in enumerate(tqdm(points)):
-      x_c = point[0]
-      y_c = point[1]
-
-      x_c_r = (x_array <= x_c + rmin)
-      x_c_l = (x_array >= x_c - rmin)
-
-      y_c_r = (y_array <= y_c + rmin)
-      y_c_l = (y_array >= y_c - rmin)
-
-      result_mask = x_c_r & x_c_l & y_c_r & y_c_l
-
-      nearest_indeces = indeces[result_mask]
-      distances = np.sqrt((x_c - x_array[nearest_indeces])**2 + (y_c - y_array[nearest_indeces])**2)
-      fac = rmin - distances
-      sH_i = np.maximum(0.0,fac)
-
-      H[i, nearest_indeces] = sH_i
-
-  return H.tocsc()
+def filter_matrix(points, rmin, block_size=256):
+    """
+    Sparse filter matrix H_ij = max(0, rmin - |p_i - p_j|) of the points.
+    The rows are built by blocks of points sorted by x, the neighbours of
+    a block are searched in its x-range +- rmin only (points may be memory-mapped).
+    """
+    x_array = np.array(points[:, 0])
+    order = np.argsort(x_array, kind="stable")
+    x_sorted = x_array[order]
+    y_sorted = np.array(points[:, 1])[order]
+
+    rows = []
+    cols = []
+    values = []
+    print("Build filter matrix ...")
+    for start in tqdm(range(0, points.shape[0], block_size)):
+        block = slice(start, min(start + block_size, points.shape[0]))
+        lo = np.searchsorted(x_sorted, x_sorted[block.start] - rmin, side="left")
+        hi = np.searchsorted(x_sorted, x_sorted[block.stop-1] + rmin, side="right")
+
+        dx = x_sorted[block, None] - x_sorted[None, lo:hi]
+        dy = y_sorted[block, None] - y_sorted[None, lo:hi]
+        fac = rmin - np.sqrt(dx**2 + dy**2)
+        i, j = np.nonzero((fac > 0) & (np.abs(dx) <= rmin) & (np.abs(dy) <= rmin))
+        rows.append(order[start + i])
+        cols.append(order[lo + j])
+        values.append(fac[i, j])
+
+    n = points.shape[0]
+    return sparse.csc_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))), shape=(n, n))
 
 
 def fit_ellipsoid(x, target_area):
@@ -0,0 +1,702 @@
+import os
+import json
+
+import numpy as np
+from scipy import sparse
+from scipy.sparse import linalg as sla
+import matplotlib.tri as mtri
+
+
+def dof_renumbering(dofs, ndof):
+    """
+    Returns an array mapping global dof indeces to their position in dofs,
+    dofs which are not in the list are mapped to -1.
+    """
+    dof_map = -np.ones(ndof, dtype=np.int64)
+    dof_map[dofs] = np.arange(len(dofs))
+    return dof_map
+
+
+class CSCAssembler:
+    """
+    Assembly plan for a sparse matrix with a fixed sparsity pattern.
+
+    The symbolic pass is done once: every triplet (iK[k], jK[k]) is mapped
+    to its slot in the data array of a CSC matrix. After that each assembly
+    is a single scatter-add of the triplet values into the persistent
+    matrix, without building a coo_matrix and sorting it every iteration.
+
+    If rows and/or cols (lists of global dofs) are given, the block
+    K[rows,:][:,cols] is assembled directly, triplets falling outside
+    the block are dropped during the scatter.
+    """
+
+    def __init__(self, iK, jK, shape, rows=None, cols=None, chunks=None, slots=None):
+        row_map = None if rows is None else dof_renumbering(rows, shape[0])
+        col_map = None if cols is None else dof_renumbering(cols, shape[1])
+        shape = (shape[0] if rows is None else len(rows), shape[1] if cols is None else len(cols))
+        self.shape = shape
+
+        def block_keys(chunk):
+            # column-major keys give the CSC ordering after sorting, -1 outside the block
+            i = iK[chunk] if row_map is None else row_map[iK[chunk]]
+            j = jK[chunk] if col_map is None else col_map[jK[chunk]]
+            keys = j.astype(np.int64)*shape[0] + i
+            keys[(i < 0) | (j < 0)] = -1
+            return keys
+
+        # symbolic pass by chunks of triplets (iK, jK may be memory-mapped),
+        # the pattern is the union of the patterns of the chunks
+        if chunks is None:
+            chunks = [slice(0, iK.shape[0])]
+        unique_keys = np.unique(np.concatenate([np.unique(block_keys(chunk)) for chunk in chunks]))
+        unique_keys = unique_keys[unique_keys >= 0]
+        self.nnz = unique_keys.shape[0]
+
+        # triplets outside the block go to an extra slot which is discarded,
+        # slots may be a preallocated (memory-mapped) array
+        self.slots = np.empty(iK.shape[0], dtype=np.int64) if slots is None else slots
+        for chunk in chunks:
+            keys = block_keys(chunk)
+            self.slots[chunk] = np.where(keys >= 0, np.searchsorted(unique_keys, keys), self.nnz)
+
+        index_dtype = np.int32 if max(self.nnz, shape[0]) < np.iinfo(np.int32).max else np.int64
+        indices = (unique_keys % shape[0]).astype(index_dtype)
+        cols_ids = unique_keys // shape[0]
+        indptr = np.zeros(shape[1]+1, dtype=index_dtype)
+        np.cumsum(np.bincount(cols_ids, minlength=shape[1]), out=indptr[1:])
+
+        self.K = sparse.csc_matrix((np.zeros(self.nnz), indices, indptr), shape=shape)
+        self.K.has_sorted_indices = True
+
+    @classmethod
+    def from_pattern(cls, slots, indices, indptr, shape):
+        """Assembly plan from stored triplet slots and CSC pattern (indices, indptr) of the matrix."""
+        assembler = cls.__new__(cls)
+        assembler.shape = shape
+        assembler.nnz = indices.shape[0]
+        assembler.slots = slots
+        assembler.K = sparse.csc_matrix((np.zeros(assembler.nnz), np.array(indices), np.array(indptr)), shape=shape)
+        assembler.K.has_sorted_indices = True
+        return assembler
+
+    def assemble(self, sK, K=None):
+        """
+        Scatter-add triplet values sK into the persistent CSC matrix,
+        or into K if given (a copy of the persistent matrix).
+        """
+        if K is None:
+            K = self.K
+        K.data[:] = np.bincount(self.slots, weights=sK, minlength=self.nnz+1)[:self.nnz]
+        return K
+
+    def assemble_elements(self, K_sep, E, chunks, K=None):
+        """
+        Assembles the element matrices K_sep (one flattened matrix per row,
+        triplets in the order of the plan) scaled by E chunk by chunk of
+        elements, K_sep and the slots are only read by chunks (e.g. from
+        memory-mapped files).
+        """
+        if K is None:
+            K = self.K
+        block = K_sep.shape[1]
+        data = np.zeros(self.nnz+1)
+        for chunk in chunks:
+            sK = (K_sep[chunk]*E[chunk, None]).ravel()
+            data += np.bincount(self.slots[block*chunk.start:block*chunk.stop], weights=sK, minlength=self.nnz+1)
+        K.data[:] = data[:self.nnz]
+        return K
+
+
+class CSCSubmatrix:
+    """
+    Persistent block K[rows][:, cols] of a CSC matrix with fixed pattern
+    (e.g. of a CSCAssembler): the positions of the block entries in K.data
+    are found once, an update is a single gather of the data.
+    """
+
+    def __init__(self, K, rows, cols):
+        # index the entries by their (1-based) position, explicit zeros would be dropped
+        K_index = sparse.csc_matrix((np.arange(1, K.nnz+1, dtype=float), K.indices, K.indptr), shape=K.shape)
+        self.K = K_index[rows][:, cols].tocsc()
+        self.K.sort_indices()
+        self.positions = self.K.data.astype(np.int64) - 1
+
+    def update(self, K, block=None):
+        """
+        Copies the block entries of K (same pattern as at construction) into
+        the persistent block, or into block if given (a copy of the persistent block).
+        """
+        if block is None:
+            block = self.K
+        block.data[:] = K.data[self.positions]
+        return block
+
+
+# arrays in a bundle start at multiples of the page size
+BUNDLE_ALIGNMENT = 4096
+
+
+class ElementBundle:
+    """
+    Writer of a single-file bundle of named arrays which are opened with
+    np.memmap (see load_bundle): arrays larger than RAM are paged in on
+    demand and all processes reading the bundle share one copy in the page
+    cache.
+
+    Layout: the raw arrays (C order, aligned to BUNDLE_ALIGNMENT bytes),
+    the JSON header {"arrays": {name: [dtype, shape, offset]}, "meta": meta}
+    and its length as 8-byte little-endian integer at the end of the file.
+
+    The bundle is written to a temporary file which replaces filename on
+    close(), so concurrent writers and readers always see complete bundles.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.tmp_filename = f"{filename}.{os.getpid()}.tmp"
+        self.arrays = {}
+        self.header = {}
+        self.size = 0
+        open(self.tmp_filename, "wb").close()
+
+    def add(self, name, shape, dtype=float, data=None):
+        """Appends the array name and returns it as writable memmap (filled with data if given)."""
+        dtype = np.dtype(dtype if data is None else data.dtype)
+        shape = tuple(int(n) for n in (shape if data is None else data.shape))
+        offset = -(-self.size // BUNDLE_ALIGNMENT)*BUNDLE_ALIGNMENT
+        self.size = offset + int(np.prod(shape))*dtype.itemsize
+        with open(self.tmp_filename, "r+b") as fp:
+            fp.truncate(self.size)
+        array = np.memmap(self.tmp_filename, dtype=dtype, mode="r+", offset=offset, shape=shape)
+        if data is not None:
+            array[:] = data
+        self.arrays[name] = array
+        self.header[name] = [dtype.str, list(shape), offset]
+        return array
+
+    def close(self, meta=None):
+        """Writes the header, moves the bundle to filename and returns load_bundle(filename)."""
+        for array in self.arrays.values():
+            array.flush()
+        header = json.dumps({"arrays": self.header, "meta": meta}).encode()
+        with open(self.tmp_filename, "r+b") as fp:
+            fp.seek(self.size)
+            fp.write(header)
+            fp.write(len(header).to_bytes(8, "little"))
+        os.replace(self.tmp_filename, self.filename)
+        self.arrays = {}
+        return load_bundle(self.filename)
+
+
+def load_bundle(filename):
+    """
+    Opens a bundle written by ElementBundle, returns the dict of read-only
+    memmaps of its arrays and the meta data stored with it.
+    """
+    with open(filename, "rb") as fp:
+        fp.seek(-8, os.SEEK_END)
+        header_size = int.from_bytes(fp.read(8), "little")
+        fp.seek(-8-header_size, os.SEEK_END)
+        header = json.loads(fp.read(header_size))
+    arrays = {name: np.memmap(filename, dtype=np.dtype(dtype), mode="r", offset=offset, shape=tuple(shape))
+              for name, (dtype, shape, offset) in header["arrays"].items()}
+    return arrays, header["meta"]
+
+
+def element_chunks(n, bytes_per_element, memory_limit, workers=1):
+    """
+    Splits range(n) into slices such that workers chunks processed at the
+    same time need at most memory_limit bytes of temporaries.
+    """
+    chunk_size = max(1, int(memory_limit // (bytes_per_element*workers)))
+    return [slice(start, min(start + chunk_size, n)) for start in range(0, n, chunk_size)]
+
+
+def rigid_body_modes(q):
+    """Returns the (2*nq, 3) array of 2D rigid body modes: x, y translations and rotation."""
+    modes = np.zeros((2*q.shape[0], 3))
+    modes[0::2, 0] = 1
+    modes[1::2, 1] = 1
+    modes[0::2, 2] = -q[:, 1]
+    modes[1::2, 2] = q[:, 0]
+    return modes
+
+
+def classify_elements(q, me, rtol=1e-8):
+    """
+    Groups the elements of a mesh by shape and orientation. Elements with the
+    same edge vectors q[me[:, 1]] - q[me[:, 0]], q[me[:, 2]] - q[me[:, 0]]
+    (up to rtol of the mesh size) have the same stiffness block.
+
+    Returns element_types, the (nme,) type of every element, and
+    representatives, the index of one element of each type.
+    """
+    edges = np.concatenate((q[me[:, 1]] - q[me[:, 0]], q[me[:, 2]] - q[me[:, 0]]), axis=1)
+    scale = rtol*np.abs(edges).max()
+    _, representatives, element_types = np.unique(np.round(edges/scale), axis=0,
+                                                  return_index=True, return_inverse=True)
+    return element_types.ravel(), representatives
+
+
+def structured_grid(q, me, element_types, rtol=1e-8):
+    """
+    Lattice of a regular triangulation for GridStiffnessOperator: the nodes
+    have to form a full (ny+1, nx+1) grid and every cell has to be split the
+    same way, i.e. each placement of an element type in a cell (its corners)
+    occurs once in every cell.
+
+    Returns node_grid, the (ny+1, nx+1) node of every grid point, and the
+    stencils, one (element type, (3, 2) cell corners (dy, dx) of the element
+    nodes, (ny, nx) element of every cell) tuple per placement; None if the
+    mesh is not such a lattice.
+    """
+    scale = rtol*np.abs(q).max()
+    ys, iy = np.unique(np.round(q[:, 1]/scale), return_inverse=True)
+    xs, ix = np.unique(np.round(q[:, 0]/scale), return_inverse=True)
+    iy, ix = iy.ravel(), ix.ravel()
+    if ys.shape[0]*xs.shape[0] != q.shape[0]:
+        return None
+    node_grid = np.full((ys.shape[0], xs.shape[0]), -1)
+    node_grid[iy, ix] = np.arange(q.shape[0])
+    if (node_grid < 0).any():
+        return None
+
+    cell_y, cell_x = iy[me].min(1), ix[me].min(1)
+    corners = np.stack((iy[me] - cell_y[:, None], ix[me] - cell_x[:, None]), axis=2)    # (nme, 3, 2)
+    if corners.max() > 1:
+        return None
+
+    # placements: element type and corners of its nodes
+    keys = element_types*64 + (corners.reshape(-1, 6) << np.arange(6)).sum(1)
+    _, representatives, placements = np.unique(keys, return_index=True, return_inverse=True)
+    stencils = []
+    for s, e in enumerate(representatives):
+        elements = np.flatnonzero(placements.ravel() == s)
+        element_grid = np.full((ys.shape[0]-1, xs.shape[0]-1), -1)
+        element_grid[cell_y[elements], cell_x[elements]] = elements
+        if (element_grid < 0).any() or elements.shape[0] != element_grid.size:
+            return None
+        stencils.append((element_types[e], corners[e], element_grid))
+    return node_grid, stencils
+
+
+def element_compliance(u, edof, K_sep, v=None):
+    """
+    Computes the element compliances u_e^T K_e u_e for all elements at once.
+
+    u     is the global displacement vector,
+    edof  is the (nme, 6) array of element dofs,
+    K_sep is the (nme, 36) array of flattened element stiffness matrices.
+
+    If v is given, v_e^T K_e u_e is computed instead (adjoint sensitivities
+    with the adjoint solution v).
+    """
+    u_e = u[edof]                                                    # (nme, 6)
+    Ku_e = np.einsum('eij,ej->ei', K_sep.reshape(-1, 6, 6), u_e)
+    return np.einsum('ei,ei->e', u_e if v is None else v[edof], Ku_e)
+
+
+def element_strains(u, edof, B, element_types=None):
+    """
+    Computes the strains (eps_xx, eps_yy, gamma_xy) of all elements at once,
+    B is the (nme, 3, 6) array of strain-displacement matrices, or the
+    (ntypes, 3, 6) matrices of the element types with element_types.
+    Returns a (nme, 3) array.
+    """
+    u_e = u[edof]                                                    # (nme, 6)
+    if element_types is None:
+        return np.matmul(B, u_e[:, :, None])[:, :, 0]
+    strains = np.empty((edof.shape[0], 3))
+    for t in range(B.shape[0]):
+        elements = element_types == t
+        strains[elements] = u_e[elements] @ B[t].T
+    return strains
+
+
+def von_mises(stress):
+    """Von Mises stress of (nme, 3) plane stresses (s_xx, s_yy, s_xy)."""
+    sx, sy, sxy = stress[:, 0], stress[:, 1], stress[:, 2]
+    return np.sqrt(sx**2 - sx*sy + sy**2 + 3*sxy**2)
+
+
+def round_significant(a, digits):
+    """Rounds a to the given number of significant digits (compact logging)."""
+    a = np.asarray(a, dtype=float)
+    magnitude = np.floor(np.log10(np.abs(np.where(a == 0, 1, a))))
+    scale = 10.0**(digits - 1 - magnitude)
+    return np.round(a*scale)/scale
+
+
+class CompactElements:
+    """
+    Compact storage of the P1 elasticity element matrices
+    K_e = A_e B_e^T C B_e: per element only the shape function gradients
+    (dN_1/dx, dN_2/dx, dN_3/dx, dN_1/dy, dN_2/dy, dN_3/dy), which define the
+    strain-displacement matrix B_e, are stored (48 bytes in place of the
+    288 bytes of a K_sep row), with the element areas and the Hooke matrix C.
+
+    Indexing returns flattened element matrices like K_sep (compact[elements]
+    is the (n, 36) array K_sep[elements]), so assembly by chunks of elements
+    (CSCAssembler.assemble_elements) and stiffness_update work on it, strains,
+    compliances and the products K_e u_e of the matrix-free operator are
+    computed from the gradients directly.
+    """
+
+    def __init__(self, gradients, areas, C):
+        self.gradients = gradients
+        self.areas = areas
+        self.C = C
+        self.shape = (gradients.shape[0], 36)
+
+    def strain_matrices(self, elements=slice(None)):
+        """Returns the (n, 3, 6) strain-displacement matrices B_e of the elements."""
+        G = self.gradients[elements]
+        B = np.zeros((G.shape[0], 3, 6))
+        B[:, 0, 0::2] = G[:, :3]
+        B[:, 1, 1::2] = G[:, 3:]
+        B[:, 2, 0::2] = G[:, 3:]
+        B[:, 2, 1::2] = G[:, :3]
+        return B
+
+    def __getitem__(self, elements):
+        if isinstance(elements, (int, np.integer)):
+            return self[elements:elements+1][0]
+        B = self.strain_matrices(elements)
+        CB = np.matmul(self.C, B)*self.areas[elements, None, None]
+        return np.matmul(B.transpose(0, 2, 1), CB).reshape(-1, 36)
+
+    def strains(self, u, edof, elements=slice(None)):
+        """Returns the (n, 3) strains (eps_xx, eps_yy, gamma_xy) of the elements for the displacements u."""
+        return self.element_strains(u[edof[elements]], elements)
+
+    def element_strains(self, u_e, elements=slice(None)):
+        """Returns the (n, 3) strains of the elements for their (n, 6) displacements u_e."""
+        G = self.gradients[elements]
+        ux = u_e[:, 0::2]
+        uy = u_e[:, 1::2]
+        return np.stack([np.einsum('ei,ei->e', G[:, :3], ux),
+                         np.einsum('ei,ei->e', G[:, 3:], uy),
+                         np.einsum('ei,ei->e', G[:, 3:], ux) + np.einsum('ei,ei->e', G[:, :3], uy)], axis=1)
+
+    def compliance(self, u, edof, v=None, elements=slice(None)):
+        """
+        Returns u_e^T K_e u_e = A_e eps_e^T C eps_e of the elements, or
+        v_e^T K_e u_e if v is given (see element_compliance).
+        """
+        eps_u = self.strains(u, edof, elements)
+        eps_v = eps_u if v is None else self.strains(v, edof, elements)
+        return self.areas[elements]*np.einsum('ei,ei->e', eps_v, eps_u @ self.C.T)
+
+    def products(self, u_e, elements=slice(None)):
+        """Returns the (n, 6) products K_e u_e = A_e B_e^T C B_e u_e of the elements."""
+        G = self.gradients[elements]
+        stress = self.areas[elements, None]*(self.element_strains(u_e, elements) @ self.C.T)
+        Ku_e = np.empty(u_e.shape)
+        Ku_e[:, 0::2] = G[:, :3]*stress[:, 0:1] + G[:, 3:]*stress[:, 2:3]
+        Ku_e[:, 1::2] = G[:, 3:]*stress[:, 1:2] + G[:, :3]*stress[:, 2:3]
+        return Ku_e
+
+    def diagonal(self, elements=slice(None)):
+        """Returns the (n, 6) diagonals of the element matrices K_e."""
+        gx = self.gradients[elements, :3]
+        gy = self.gradients[elements, 3:]
+        C = self.C
+        diag_e = np.empty((gx.shape[0], 6))
+        diag_e[:, 0::2] = C[0, 0]*gx**2 + 2*C[0, 2]*gx*gy + C[2, 2]*gy**2
+        diag_e[:, 1::2] = C[1, 1]*gy**2 + 2*C[1, 2]*gx*gy + C[2, 2]*gx**2
+        return self.areas[elements, None]*diag_e
+
+
+def stiffness_update(edof, K_sep, dE, elements, dof_map):
+    """
+    Returns the change of the stiffness matrix sum_e dE_e K_e over the given
+    elements as a dense block: (dofs, D) with dK[dofs][:, dofs] = D.
+
+    dof_map maps global dofs to the dofs of the system (-1 for dropped dofs,
+    see dof_renumbering), dofs are sorted system dof indices.
+    """
+    loc = dof_map[edof[elements]]                                    # (n, 6)
+    inside = loc >= 0
+    dofs = np.unique(loc[inside])
+    if dofs.shape[0] == 0:
+        return dofs, np.zeros((0, 0))
+    pos = np.searchsorted(dofs, np.where(inside, loc, dofs[0]))
+
+    Ke = K_sep[elements].reshape(-1, 6, 6)*dE[elements, None, None]
+    Ke *= inside[:, :, None] & inside[:, None, :]
+
+    D = np.zeros((dofs.shape[0], dofs.shape[0]))
+    np.add.at(D, (pos[:, :, None], pos[:, None, :]), Ke)
+    return dofs, D
+
+
+class ElementStiffnessOperator(sla.LinearOperator):
+    """
+    Matrix-free stiffness operator K[dofs][:, dofs] = sum_e E_e K_e.
+
+    K u is applied element by element: gather u[edof], multiply by the
+    element blocks scaled by E and scatter-add the result, so neither the
+    triplet indices nor the assembled matrix are stored. Without dofs the
+    operator acts on all ndof dofs.
+
+    With element_types (structured meshes, see classify_elements) K_sep
+    holds only the reference blocks of the element types, the elements are
+    grouped by type and each group is applied as one dense product. K_sep
+    may also be CompactElements, then the products are formed from the
+    shape function gradients and no (nme, 36) blocks are stored.
+    """
+
+    def __init__(self, edof, K_sep, ndof, dofs=None, element_types=None):
+        self.ndof = ndof
+        self.dofs = np.arange(ndof) if dofs is None else dofs
+        self.element_types = element_types
+        self.E = np.ones(edof.shape[0])
+        self.compact = isinstance(K_sep, CompactElements)
+        if self.compact:
+            self.edof = edof
+            self.Ke = K_sep
+        elif element_types is None:
+            self.edof = edof
+            self.Ke = K_sep.reshape(-1, 6, 6)
+        else:
+            # elements sorted by type, groups are contiguous slices
+            self.order = np.argsort(element_types, kind='stable')
+            self.edof = edof[self.order]
+            self.Ke = K_sep.reshape(-1, 6, 6)
+            self.groups = np.concatenate(([0], np.cumsum(np.bincount(element_types, minlength=self.Ke.shape[0]))))
+        super().__init__(dtype=np.float64, shape=(len(self.dofs), len(self.dofs)))
+
+    def set_E(self, E):
+        """Sets the element stiffnesses E_e (Emin + x^penal (Emax-Emin) for SIMP)."""
+        self.E = E if self.element_types is None else E[self.order]
+
+    def apply(self, u):
+        """Returns K u for a full (ndof,) or (ndof, n) displacement array."""
+        if u.ndim == 2:
+            return np.stack([self.apply(u[:, i]) for i in range(u.shape[1])], axis=1)
+        Eu_e = self.E[:, None]*u[self.edof]
+        if self.compact:
+            Ku_e = self.Ke.products(Eu_e)
+        elif self.element_types is None:
+            Ku_e = np.matmul(self.Ke, Eu_e[:, :, None])[:, :, 0]
+        else:
+            Ku_e = np.empty_like(Eu_e)
+            for t in range(self.Ke.shape[0]):
+                g = slice(self.groups[t], self.groups[t+1])
+                Ku_e[g] = Eu_e[g] @ self.Ke[t].T
+        return np.bincount(self.edof.ravel(), weights=Ku_e.ravel(), minlength=self.ndof)
+
+    def element_compliance(self, u, v=None):
+        """
+        Returns u_e^T K_e u_e (without E) of all elements for the full
+        displacement vector u, or v_e^T K_e u_e if v is given.
+        """
+        if self.compact:
+            return self.Ke.compliance(u, self.edof, v)
+        if self.element_types is None:
+            return element_compliance(u, self.edof, self.Ke, v=v)
+        u_e = u[self.edof]
+        v_e = u_e if v is None else v[self.edof]
+        ce_sorted = np.empty(self.edof.shape[0])
+        for t in range(self.Ke.shape[0]):
+            g = slice(self.groups[t], self.groups[t+1])
+            ce_sorted[g] = np.einsum('ei,ei->e', v_e[g], u_e[g] @ self.Ke[t].T)
+        ce = np.empty_like(ce_sorted)
+        ce[self.order] = ce_sorted
+        return ce
+
+    def _matvec(self, x):
+        u = np.zeros(self.ndof)
+        u[self.dofs] = x.ravel()
+        return self.apply(u)[self.dofs]
+
+    def _matmat(self, X):
+        return np.stack([self._matvec(X[:, i]) for i in range(X.shape[1])], axis=1)
+
+    def _adjoint(self):
+        return self
+
+    def diagonal(self):
+        diag_e = self.Ke.diagonal() if self.compact else np.einsum('eii->ei', self.Ke)
+        if self.element_types is not None:
+            diag_e = np.repeat(diag_e, np.diff(self.groups), axis=0)
+        diag_e = diag_e*self.E[:, None]
+        return np.bincount(self.edof.ravel(), weights=diag_e.ravel(), minlength=self.ndof)[self.dofs]
+
+
+class GridStiffnessOperator(sla.LinearOperator):
+    """
+    Stencil form of ElementStiffnessOperator on a regular triangulation
+    (see structured_grid): the displacements are arranged on the node grid
+    and every element placement is applied to all cells at once through
+    shifted slices of the grid, no element dofs are gathered or scattered.
+    K_sep holds the reference blocks of the element types.
+    """
+
+    def __init__(self, node_grid, stencils, K_sep, ndof, dofs=None):
+        self.ndof = ndof
+        self.dofs = np.arange(ndof) if dofs is None else dofs
+        # dofs of the (2, ny+1, nx+1) displacement components on the grid
+        self.grid_dofs = 2*node_grid[None] + np.arange(2)[:, None, None]
+        self.stencils = stencils
+        self.Ke = K_sep.reshape(-1, 6, 6)
+        self.cells = (node_grid.shape[0]-1, node_grid.shape[1]-1)
+        self.nme = sum(element_grid.size for _, _, element_grid in stencils)
+        self.E = [np.ones(self.cells) for _ in stencils]
+        super().__init__(dtype=np.float64, shape=(len(self.dofs), len(self.dofs)))
+
+    def set_E(self, E):
+        """Sets the element stiffnesses E_e, as cell arrays of the stencils."""
+        self.E = [E[element_grid] for _, _, element_grid in self.stencils]
+
+    def grid_values(self, u):
+        # (2, ny+1, nx+1) displacement components on the grid points
+        return np.take(u, self.grid_dofs)
+
+    def from_grid(self, U):
+        u = np.empty(self.ndof)
+        u[self.grid_dofs] = U
+        return u
+
+    def cell_values(self, U, corners):
+        # (6, ny*nx) element displacements of all cells from shifted slices of the grid
+        ny, nx = self.cells
+        return np.stack([U[:, dy:dy+ny, dx:dx+nx] for dy, dx in corners]).reshape(6, -1)
+
+    def apply(self, u):
+        """Returns K u for a full (ndof,) or (ndof, n) displacement array."""
+        if u.ndim == 2:
+            return np.stack([self.apply(u[:, i]) for i in range(u.shape[1])], axis=1)
+        ny, nx = self.cells
+        U = self.grid_values(u)
+        KU = np.zeros_like(U)
+        for (t, corners, _), E in zip(self.stencils, self.E):
+            Ku_c = (self.Ke[t] @ (self.cell_values(U, corners)*E.ravel())).reshape(3, 2, ny, nx)
+            for a, (dy, dx) in enumerate(corners):
+                KU[:, dy:dy+ny, dx:dx+nx] += Ku_c[a]
+        return self.from_grid(KU)
+
+    def element_compliance(self, u, v=None):
+        """
+        Returns u_e^T K_e u_e (without E) of all elements for the full
+        displacement vector u, or v_e^T K_e u_e if v is given.
+        """
+        U = self.grid_values(u)
+        V = U if v is None else self.grid_values(v)
+        ce = np.empty(self.nme)
+        for t, corners, element_grid in self.stencils:
+            U_c = self.cell_values(U, corners)
+            V_c = U_c if v is None else self.cell_values(V, corners)
+            ce[element_grid.ravel()] = np.einsum('ic,ic->c', V_c, self.Ke[t] @ U_c)
+        return ce
+
+    def _matvec(self, x):
+        u = np.zeros(self.ndof)
+        u[self.dofs] = x.ravel()
+        return self.apply(u)[self.dofs]
+
+    def _matmat(self, X):
+        return np.stack([self._matvec(X[:, i]) for i in range(X.shape[1])], axis=1)
+
+    def _adjoint(self):
+        return self
+
+    def diagonal(self):
+        ny, nx = self.cells
+        D = np.zeros(self.grid_dofs.shape)
+        for (t, corners, _), E in zip(self.stencils, self.E):
+            diag_e = np.diagonal(self.Ke[t])
+            for a, (dy, dx) in enumerate(corners):
+                D[:, dy:dy+ny, dx:dx+nx] += diag_e[2*a:2*a+2, None, None]*E
+        return self.from_grid(D)[self.dofs]
+
+
+class NormalEquationsOperator(sla.LinearOperator):
+    """
+    Operator gamma_1 K^T K + gamma_3 I of the ADMM displacement update for
+    a sparse column block K (e.g. K[:, free]), applied as
+    gamma_1 K^T (K v) + gamma_3 v, so that K^T K (roughly the squared
+    bandwidth and fill of K) is never formed. The diagonal (Jacobi
+    preconditioner) is gamma_1 times the squared column norms of K plus gamma_3.
+    """
+
+    def __init__(self, K, gamma_1, gamma_3):
+        self.K = K
+        self.gamma_1 = gamma_1
+        self.gamma_3 = gamma_3
+        super().__init__(dtype=np.float64, shape=(K.shape[1], K.shape[1]))
+
+    def _matvec(self, x):
+        x = x.ravel()
+        return self.gamma_1*(self.K.T @ (self.K @ x)) + self.gamma_3*x
+
+    def _matmat(self, X):
+        return self.gamma_1*(self.K.T @ (self.K @ X)) + self.gamma_3*X
+
+    def _adjoint(self):
+        return self
+
+    def diagonal(self):
+        return self.gamma_1*np.asarray(self.K.power(2).sum(axis=0)).ravel() + self.gamma_3
+
+
+def interpolation_matrix(q_fine, q_coarse, me_coarse):
+    """
+    P1 interpolation from a coarse mesh onto the nodes of a fine mesh of the
+    same geometry (meshes need not be nested), as (nq_fine, nq_coarse)
+    sparse matrix acting on nodal values. Fine nodes outside the coarse
+    mesh (round-off on the boundary) use the nearest coarse element with
+    clipped barycentric coordinates.
+    """
+    triangulation = mtri.Triangulation(q_coarse[:, 0], q_coarse[:, 1], me_coarse)
+    elements = triangulation.get_trifinder()(q_fine[:, 0], q_fine[:, 1])
+
+    outside = elements < 0
+    if outside.any():
+        centroids = q_coarse[me_coarse].mean(1)
+        for i in np.flatnonzero(outside):
+            elements[i] = np.argmin(np.linalg.norm(centroids - q_fine[i], axis=1))
+
+    # barycentric coordinates
+    v = q_coarse[me_coarse[elements]]                                # (nq, 3, 2)
+    T = np.stack((v[:, 1] - v[:, 0], v[:, 2] - v[:, 0]), axis=2)     # (nq, 2, 2)
+    l12 = np.linalg.solve(T, (q_fine - v[:, 0])[:, :, None])[:, :, 0]
+    weights = np.column_stack((1 - l12.sum(1), l12))
+    weights = np.clip(weights, 0, None)
+    weights /= weights.sum(1, keepdims=True)
+
+    rows = np.repeat(np.arange(q_fine.shape[0]), 3)
+    return sparse.csr_matrix((weights.ravel(), (rows, me_coarse[elements].ravel())),
+                             shape=(q_fine.shape[0], q_coarse.shape[0]))
+
+
+def select_nodes(q, x_spec, y_spec):
+    """
+    Boolean mask of the nodes selected by a problem definition entry: each
+    coordinate spec is either a value (np.isclose) or a [min, max] range.
+    """
+    mask = np.ones(q.shape[0], dtype=bool)
+    for k, spec in enumerate((x_spec, y_spec)):
+        if isinstance(spec, list):
+            mask &= (q[:, k] >= spec[0]) & (q[:, k] <= spec[1])
+        else:
+            mask &= np.isclose(q[:, k], spec)
+    return mask
+
+
+def constrained_nodes(q, problem_args):
+    """(nq, 2) boolean array of the x/y components fixed by "fixed_x", "fixed_y", "fixed_xy"."""
+    fixed = np.zeros((q.shape[0], 2), dtype=bool)
+    for fixed_case, components in [("fixed_x", [0]), ("fixed_y", [1]), ("fixed_xy", [0, 1])]:
+        for case in problem_args[fixed_case]:
+            fixed[np.ix_(select_nodes(q, case[0], case[1]), components)] = True
+    return fixed
+
+
+def nodal_loads(q, load_list):
+    """(nq, 2) array of nodal forces of a "loads" list, later entries overwrite earlier ones."""
+    loads = np.zeros((q.shape[0], 2))
+    for case in load_list:
+        loads[select_nodes(q, case[0][0], case[0][1])] = case[1]
+    return loads
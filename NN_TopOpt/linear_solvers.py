@@ -0,0 +1,566 @@
+import time
+
+import numpy as np
+import scipy.linalg
+from scipy import sparse
+from scipy.sparse import linalg as sla
+
+# SuperLU options for SPD matrices: symmetric ordering and no pivoting
+SYMMETRIC_OPTIONS = {"diag_pivot_thresh": 0.0, "options": {"SymmetricMode": True}}
+
+
+def same_pattern(A, indptr, indices):
+    """Checks if the CSC matrix A has the sparsity pattern (indptr, indices)."""
+    if A.indptr is indptr and A.indices is indices:
+        return True
+    return np.array_equal(A.indptr, indptr) and np.array_equal(A.indices, indices)
+
+
+class SymmetricPermutation:
+    """
+    Symmetric permutation A[perm][:, perm] of CSC matrices sharing one sparsity pattern.
+
+    The permuted pattern and the gather map for the data array are computed
+    once, after that permuting a matrix with the same pattern is a single gather.
+    """
+
+    def __init__(self, A, perm):
+        self.perm = perm
+        self.shape = A.shape
+        self.indptr = A.indptr
+        self.indices = A.indices
+
+        slots = sparse.csc_matrix((np.arange(1, A.nnz+1, dtype=float), A.indices, A.indptr), shape=A.shape)
+        P = slots[perm][:, perm].tocsc()
+        P.sort_indices()
+        self.gather = P.data.astype(np.int64) - 1
+        self.P_indices = P.indices
+        self.P_indptr = P.indptr
+
+    def matches(self, A):
+        return A.shape == self.shape and A.nnz == self.gather.shape[0] and same_pattern(A, self.indptr, self.indices)
+
+    def apply(self, A):
+        return sparse.csc_matrix((A.data[self.gather], self.P_indices, self.P_indptr), shape=self.shape)
+
+
+def incomplete_cholesky(A, drop_tol=1e-4, fill_factor=10):
+    """
+    Incomplete Cholesky preconditioner M^-1 = P^T L^-T D^-1 L^-1 P for the SPD matrix A.
+
+    SciPy has no incomplete Cholesky, so the threshold incomplete LU of SuperLU
+    is computed in symmetric mode (symmetric fill-reducing ordering, no pivoting)
+    and only its unit lower factor L and the pivots D are kept, which gives a
+    symmetric positive definite preconditioner suitable for CG.
+    """
+    ilu = sla.spilu(A.tocsc(), drop_tol=drop_tol, fill_factor=fill_factor,
+                    permc_spec="MMD_AT_PLUS_A", diag_pivot_thresh=0.0,
+                    options={"SymmetricMode": True})
+    L = ilu.L.tocsr()
+    Lt = L.T.tocsr()
+    D = np.abs(ilu.U.diagonal())
+    perm = ilu.perm_c
+    perm_inv = np.argsort(perm)
+
+    def apply(b):
+        y = sla.spsolve_triangular(L, b[perm_inv], lower=True, unit_diagonal=True)
+        y /= D if y.ndim == 1 else D[:, None]
+        return sla.spsolve_triangular(Lt, y, lower=False, unit_diagonal=True)[perm]
+
+    M = sla.LinearOperator(A.shape, matvec=apply, matmat=apply, dtype=A.dtype)
+    M.nnz = L.nnz + D.shape[0]
+    return M
+
+
+def chebyshev_preconditioner(A, degree=4, lower_ratio=30, power_iterations=15):
+    """
+    Chebyshev polynomial preconditioner built from Jacobi-scaled A.
+
+    Applies a fixed polynomial p(D^-1 A) D^-1 (degree-1 products with A),
+    which damps the spectrum of D^-1 A on [lmax/lower_ratio, lmax]. lmax is
+    estimated by power iteration. Only A @ x and A.diagonal() are needed,
+    so A can be a matrix-free operator.
+    """
+    inv_diag = 1/A.diagonal()
+    x = np.random.default_rng(0).uniform(-1, 1, A.shape[0])
+    for _ in range(power_iterations):
+        x = inv_diag*(A @ x)
+        lmax = np.linalg.norm(x)
+        x /= lmax
+    lmax *= 1.1
+    lmin = lmax/lower_ratio
+
+    theta = (lmax + lmin)/2
+    delta = (lmax - lmin)/2
+    sigma = theta/delta
+
+    def apply(r):
+        r = np.ravel(r)
+        d = inv_diag*r/theta
+        z = d.copy()
+        rho = 1/sigma
+        for _ in range(degree - 1):
+            rho_new = 1/(2*sigma - rho)
+            d = rho_new*rho*d + 2*rho_new/delta*inv_diag*(r - A @ z)
+            z += d
+            rho = rho_new
+        return z
+
+    M = sla.LinearOperator(A.shape, matvec=apply, dtype=np.float64)
+    M.nbytes = inv_diag.nbytes
+    return M
+
+
+def multigrid_preconditioner(A, prolongations, degree=2, lower_ratio=10):
+    """
+    Multigrid V-cycle for A built from given prolongation operators.
+
+    prolongations[k] maps level k+1 to level k (level 0 is A). The coarse
+    operators are the Galerkin products P^T A P, the smoothers Chebyshev
+    polynomials (see chebyshev_preconditioner) applied before and after
+    the coarse correction, the coarsest level is solved with SuperLU.
+    The V-cycle is symmetric, so it can precondition CG.
+    """
+    levels = [A.tocsr()]
+    for P in prolongations:
+        levels.append((P.T @ levels[-1] @ P).tocsr())
+    smoothers = [chebyshev_preconditioner(A_k, degree, lower_ratio) for A_k in levels[:-1]]
+    coarse = sla.splu(levels[-1].tocsc())
+
+    def vcycle(b, k=0):
+        b = np.ravel(b)
+        if k == len(prolongations):
+            return coarse.solve(b)
+        A_k, P, smooth = levels[k], prolongations[k], smoothers[k]
+        x = smooth(b)
+        x += P @ vcycle(P.T @ (b - A_k @ x), k + 1)
+        x += smooth(b - A_k @ x)
+        return x
+
+    M = sla.LinearOperator(A.shape, matvec=vcycle, dtype=np.float64)
+    M.nnz = sum(A_k.nnz for A_k in levels[1:]) + coarse.L.nnz + coarse.U.nnz
+    M.levels = [A_k.shape[0] for A_k in levels]
+    return M
+
+
+class LinearSolver:
+    """
+    Base class for linear solver backends of the FEM core.
+
+    factorize(A) prepares the backend for the matrix A (factorization or
+    preconditioner), solve(b) returns the solution for the right-hand side b.
+    After each call self.stats holds factorization time, solve time,
+    memory of the factors/preconditioner (bytes) and relative residual.
+
+    With precision "float32" (direct backends only) the factorization is
+    computed in single precision, which halves the memory of the factors.
+    The solution is refined to double precision accuracy with CG on the
+    double precision matrix, preconditioned by the single precision
+    factorization (mixed-precision iterative refinement, a few iterations).
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.A = None
+        self.stats = {}
+        self.precision = args.get("precision", "float64")
+        self.refinement_steps = args.get("refinement_steps", 10)
+        self.refinement_tol = args.get("refinement_tol", 1e-10)
+        # near null space of the operator (rigid body modes), used by AMG
+        self.near_nullspace = None
+        # prolongations of a mesh hierarchy, used by geometric multigrid
+        self.prolongations = None
+
+    def factorize(self, A):
+        start = time.perf_counter()
+        self.A = A
+        self.stats = {}
+        self._factorize(A if self.precision == "float64" else A.astype(self.precision))
+        self.stats["factor_time"] = time.perf_counter() - start
+        self.stats["memory"] = int(self.memory())
+
+    def solve(self, b, x0=None):
+        """Solves A x = b, x0 is an initial guess used by iterative backends."""
+        start = time.perf_counter()
+        x = self._solve(b, x0) if self.precision == "float64" else self._solve_refined(b)
+        self.stats["solve_time"] = time.perf_counter() - start
+        self.stats["residual"] = float(np.linalg.norm(b - self.A @ x) / max(np.linalg.norm(b), 1e-300))
+        return x
+
+    def _solve_refined(self, b):
+        if b.ndim == 2:
+            return np.stack([self._solve_refined(b[:, i]) for i in range(b.shape[1])], axis=1)
+        M = sla.LinearOperator(self.A.shape, dtype=np.float64,
+                               matvec=lambda r: self._solve(r.astype(self.precision)).astype(np.float64))
+
+        iterations = [0]
+        def count(xk):
+            iterations[0] += 1
+
+        x, info = sla.cg(self.A, b, x0=M @ b, rtol=self.refinement_tol, maxiter=self.refinement_steps,
+                         M=M, callback=count)
+        if info > 0:
+            print(f"Iterative refinement did not converge in {info} iterations")
+        self.stats["refinement_steps"] = self.stats.get("refinement_steps", 0) + iterations[0]
+        return x
+
+    def _factorize(self, A):
+        raise NotImplementedError
+
+    def _solve(self, b, x0=None):
+        raise NotImplementedError
+
+    def memory(self):
+        return 0
+
+    # whether factorize accepts a LinearOperator instead of an assembled matrix
+    matrix_free = False
+
+    # whether the backend supports single precision factorizations
+    mixed_precision = False
+
+    def update_tolerance(self, change):
+        """Adapts the solver tolerance to the design change (iterative backends only)."""
+        pass
+
+
+class SuperLUSolver(LinearSolver):
+    """
+    Sparse LU factorization (SuperLU).
+
+    With reuse_ordering (default) the matrix is treated as SPD: a symmetric
+    fill-reducing ordering is computed at the first factorization and kept
+    while the sparsity pattern stays the same, later factorizations only
+    permute the values and factorize with the natural ordering. If the
+    pattern changes (e.g. eliminated dofs), a new ordering is computed.
+    Without reuse_ordering, a general LU with permc_spec ordering is done.
+    """
+
+    def __init__(self, args):
+        super().__init__(args)
+        self.reuse_ordering = args.get("reuse_ordering", True)
+        self.permutation = None
+        self.perm = None
+
+    def _factorize(self, A):
+        if not self.reuse_ordering:
+            self.lu = sla.splu(A, permc_spec=self.args.get("permc_spec", "COLAMD"))
+            self.perm = None
+        elif self.permutation is not None and self.permutation.matches(A):
+            self.lu = sla.splu(self.permutation.apply(A), permc_spec="NATURAL", **SYMMETRIC_OPTIONS)
+            self.perm = self.permutation.perm
+            self.stats["reordered"] = False
+        else:
+            # first factorization or new sparsity pattern
+            self.lu = sla.splu(A, permc_spec="MMD_AT_PLUS_A", **SYMMETRIC_OPTIONS)
+            self.permutation = SymmetricPermutation(A, np.argsort(self.lu.perm_c))
+            self.perm = None
+            self.stats["reordered"] = True
+
+    def _solve(self, b, x0=None):
+        if self.perm is None:
+            return self.lu.solve(b)
+        x = np.empty_like(b)
+        x[self.perm] = self.lu.solve(b[self.perm])
+        return x
+
+    def memory(self):
+        # values and row indeces of L and U
+        return self.lu.nnz*(np.dtype(self.precision).itemsize + 4)
+
+    mixed_precision = True
+
+
+class CholeskySolver(LinearSolver):
+    """
+    Sparse Cholesky factorization (CHOLMOD) for the SPD elasticity system.
+
+    The symbolic analysis (ordering and factor structure) is done at the
+    first factorization and reused for numeric refactorizations while the
+    sparsity pattern stays the same.
+    """
+
+    def __init__(self, args):
+        super().__init__(args)
+        try:
+            from sksparse.cholmod import cholesky
+        except ImportError as e:
+            raise ImportError("'cholesky' solver requires scikit-sparse (pip install scikit-sparse)") from e
+        self.cholesky = cholesky
+        self.factor = None
+        self.factor_nnz = None
+
+    def _factorize(self, A):
+        A = A.tocsc()
+        if self.factor is not None and same_pattern(A, *self.pattern):
+            self.factor.cholesky_inplace(A)
+            self.stats["reordered"] = False
+        else:
+            self.factor = self.cholesky(A, ordering_method=self.args.get("ordering", "default"))
+            self.pattern = (A.indptr, A.indices)
+            self.factor_nnz = None
+            self.stats["reordered"] = True
+
+    def _solve(self, b, x0=None):
+        return self.factor(b)
+
+    def memory(self):
+        if self.factor_nnz is None:
+            self.factor_nnz = self.factor.L().nnz
+        return self.factor_nnz*(8 + 4)
+
+
+class CGSolver(LinearSolver):
+    """
+    Preconditioned conjugate gradients. Preconditioners:
+    "amg"       -- smoothed aggregation algebraic multigrid (requires pyamg),
+    "ichol"     -- incomplete Cholesky (LDL^T) factorization, see incomplete_cholesky,
+    "gmg"       -- geometric multigrid on a hierarchy of remeshed coarse meshes,
+                   see multigrid_preconditioner (prolongations set by the optimizer),
+    "jacobi"    -- diagonal scaling,
+    "chebyshev" -- Chebyshev polynomial in Jacobi-scaled A, see chebyshev_preconditioner.
+
+    "jacobi" and "chebyshev" only use A @ x and A.diagonal(), so A may be a
+    matrix-free operator (see matrix_free).
+
+    With warm_start the solve starts from the given initial guess (the
+    displacements of the previous iteration), the preconditioner is rebuilt
+    only every refresh_every factorizations and the tolerance follows the
+    design change, rtol = clip(rtol_scale*change, rtol_min, rtol_max),
+    so it tightens as the design converges.
+    """
+
+    def __init__(self, args):
+        super().__init__(args)
+        self.preconditioner = args.get("preconditioner", "amg")
+        self.rtol = args.get("rtol", 1e-8)
+        self.maxiter = args.get("maxiter", None)
+
+        self.warm_start = args.get("warm_start", False)
+        self.refresh_every = args.get("refresh_every", 1)
+        self.rtol_min = args.get("rtol_min", self.rtol)
+        self.rtol_max = args.get("rtol_max", 1e-4)
+        self.rtol_scale = args.get("rtol_scale", 1e-3)
+        self.M = None
+        self.n_factorizations = 0
+        if self.preconditioner == "amg":
+            try:
+                import pyamg
+            except ImportError as e:
+                raise ImportError("'amg' preconditioner requires pyamg (pip install pyamg)") from e
+            self.pyamg = pyamg
+
+    def _factorize(self, A):
+        refresh = (self.M is None or self.M.shape != A.shape
+                   or self.n_factorizations % self.refresh_every == 0)
+        if refresh:
+            self.M = self.build_preconditioner(A)
+        self.n_factorizations += 1
+        self.stats["preconditioner_refreshed"] = refresh
+
+    def build_preconditioner(self, A):
+        self.M_memory = 0
+        if self.preconditioner == "amg":
+            ml = self.pyamg.smoothed_aggregation_solver(A.tocsr(), B=self.near_nullspace, symmetry="hermitian")
+            self.M_memory = sum(level.A.nnz for level in ml.levels)*(8 + 4)
+            return ml.aspreconditioner(cycle="V")
+        elif self.preconditioner == "ichol":
+            M = incomplete_cholesky(A, self.args.get("drop_tol", 1e-4), self.args.get("fill_factor", 10))
+            self.M_memory = M.nnz*(8 + 4)
+            return M
+        elif self.preconditioner == "jacobi":
+            inv_diag = 1/A.diagonal()
+            self.M_memory = inv_diag.nbytes
+            return sla.LinearOperator(A.shape, lambda x: inv_diag*x)
+        elif self.preconditioner == "gmg":
+            if self.prolongations is None:
+                raise ValueError("'gmg' preconditioner requires a mesh hierarchy (see TopOptimizer2D.build_mesh_hierarchy)")
+            M = multigrid_preconditioner(A, self.prolongations, self.args.get("degree", 2))
+            self.M_memory = M.nnz*(8 + 4)
+            self.stats["levels"] = M.levels
+            return M
+        elif self.preconditioner == "chebyshev":
+            M = chebyshev_preconditioner(A, self.args.get("degree", 4))
+            self.M_memory = M.nbytes
+            return M
+        raise ValueError(f"Unknown preconditioner: {self.preconditioner}")
+
+    def _solve(self, b, x0=None):
+        if not self.warm_start:
+            x0 = None
+        self.stats["iterations"] = 0
+        self.stats["rtol"] = self.rtol
+
+        if b.ndim == 1:
+            return self._solve_vector(b, x0)
+
+        # several right-hand sides (load cases) are solved one by one
+        x = np.empty_like(b)
+        for i in range(b.shape[1]):
+            x[:, i] = self._solve_vector(b[:, i], None if x0 is None else x0[:, i])
+        return x
+
+    def _solve_vector(self, b, x0=None):
+        iterations = [0]
+
+        def count(xk):
+            iterations[0] += 1
+
+        x, info = sla.cg(self.A, b, x0=x0, rtol=self.rtol, maxiter=self.maxiter, M=self.M, callback=count)
+        if info > 0:
+            print(f"CG did not converge in {info} iterations")
+        self.stats["iterations"] += iterations[0]
+        return x
+
+    @property
+    def matrix_free(self):
+        return self.preconditioner in ("jacobi", "chebyshev")
+
+    def update_tolerance(self, change):
+        if self.warm_start:
+            self.rtol = float(np.clip(self.rtol_scale*change, self.rtol_min, self.rtol_max))
+
+    def memory(self):
+        return self.M_memory
+
+
+def deflated_pcg(A, b, x0=None, M=None, W=None, rtol=1e-8, maxiter=None):
+    """
+    Deflated preconditioned conjugate gradients (Saad et al., 2000).
+
+    The components of the solution in the span of the basis W (n, k) are
+    solved exactly by a coarse Galerkin problem W^T A W, CG only iterates on
+    the A-orthogonal complement. With W=None it is the standard PCG.
+    Returns the solution and the number of iterations.
+    """
+    n = b.shape[0]
+    maxiter = 10*n if maxiter is None else maxiter
+    x = np.zeros(n) if x0 is None else x0.copy()
+    r = b - A @ x
+
+    if W is not None:
+        AW = A @ W
+        E_inv = np.linalg.inv(W.T @ AW)
+        # initial guess with W^T r = 0
+        x += W @ (E_inv @ (W.T @ r))
+        r = b - A @ x
+
+    def precondition(r):
+        z = r if M is None else M @ r
+        if W is not None:
+            z = z - W @ (E_inv @ (AW.T @ z))
+        return z
+
+    b_norm = max(np.linalg.norm(b), 1e-300)
+    if np.linalg.norm(r) <= rtol*b_norm:
+        return x, 0
+
+    z = precondition(r)
+    p = z.copy()
+    rz = r @ z
+    for i in range(1, maxiter+1):
+        Ap = A @ p
+        alpha = rz/(p @ Ap)
+        x += alpha*p
+        r -= alpha*Ap
+        if np.linalg.norm(r) <= rtol*b_norm:
+            return x, i
+        z = precondition(r)
+        rz_new = r @ z
+        p = z + (rz_new/rz)*p
+        rz = rz_new
+
+    print(f"Deflated CG did not converge in {maxiter} iterations")
+    return x, maxiter
+
+
+class DeflatedCGSolver(CGSolver):
+    """
+    Krylov subspace recycling for the slowly varying sequence of stiffness
+    systems of a topology optimization run: deflated PCG with a basis carried
+    between solves.
+
+    The basis holds the last n_recycle solutions (orthonormalized), optionally
+    together with the near null space of the operator (rigid body modes).
+    The first solve (and every probe_every-th solve, if set) runs without
+    recycling, its iteration count is the reference used to report how many
+    CG iterations the recycling saved.
+    """
+
+    def __init__(self, args):
+        super().__init__({"preconditioner": "jacobi", **args})
+        self.n_recycle = args.get("n_recycle", 4)
+        self.use_near_nullspace = args.get("use_near_nullspace", True)
+        self.probe_every = args.get("probe_every", 0)
+        self.history = []
+        self.n_solves = 0
+        self.reference_iterations = None
+        self.total_saved = 0
+
+    def recycled_basis(self):
+        # the recycled solutions are dropped if the system size changed (eliminated dofs)
+        self.history = [x for x in self.history if x.shape[0] == self.A.shape[0]]
+        columns = list(self.history)
+        if self.use_near_nullspace and self.near_nullspace is not None and self.near_nullspace.shape[0] == self.A.shape[0]:
+            columns += list(self.near_nullspace.T)
+        if len(columns) == 0:
+            return None
+
+        W, R = np.linalg.qr(np.stack(columns, axis=1))
+        # drop (almost) linearly dependent directions
+        independent = np.abs(np.diag(R)) > 1e-10*np.abs(np.diag(R)).max()
+        return W[:, independent]
+
+    def _solve_vector(self, b, x0=None):
+        probe = self.reference_iterations is None or (self.probe_every and self.n_solves % self.probe_every == 0)
+        W = None if probe else self.recycled_basis()
+        x, iterations = deflated_pcg(self.A, b, x0=x0, M=self.M, W=W, rtol=self.rtol, maxiter=self.maxiter)
+        self.n_solves += 1
+
+        if W is None:
+            self.reference_iterations = iterations
+        else:
+            saved = self.reference_iterations - iterations
+            self.total_saved += saved
+            self.stats["iterations_saved"] = self.stats.get("iterations_saved", 0) + saved
+            print(f"Krylov recycling saved {saved} CG iterations ({self.total_saved} in total)")
+
+        self.history = (self.history + [x])[-self.n_recycle:]
+        self.stats["iterations"] += iterations
+        self.stats["recycled_dim"] = 0 if W is None else W.shape[1]
+        return x
+
+
+class DenseSolver(LinearSolver):
+    """Dense Cholesky factorization, fallback for tiny meshes."""
+
+    def _factorize(self, A):
+        A = A.toarray() if hasattr(A, "toarray") else np.asarray(A)
+        self.c_and_lower = scipy.linalg.cho_factor(A)
+
+    def _solve(self, b, x0=None):
+        return scipy.linalg.cho_solve(self.c_and_lower, b)
+
+    def memory(self):
+        return self.c_and_lower[0].nbytes
+
+    mixed_precision = True
+
+
+solvers = {"splu": SuperLUSolver,
+           "cholesky": CholeskySolver,
+           "cg_amg": lambda args: CGSolver({"preconditioner": "amg", **args}),
+           "cg_ichol": lambda args: CGSolver({"preconditioner": "ichol", **args}),
+           "cg": CGSolver,
+           "cg_warm": lambda args: CGSolver({"preconditioner": "ichol", "warm_start": True,
+                                             "refresh_every": 5, **args}),
+           "cg_gmg": lambda args: CGSolver({"preconditioner": "gmg", **args}),
+           "cg_chebyshev": lambda args: CGSolver({"preconditioner": "chebyshev", **args}),
+           "cg_jacobi_warm": lambda args: CGSolver({"preconditioner": "jacobi", "warm_start": True, **args}),
+           "cg_recycled": DeflatedCGSolver,
+           "dense": DenseSolver}
+
+
+def get_solver(args, default="splu"):
+    """Returns the solver backend selected by args["solver"] (SuperLU by default)."""
+    return solvers[args.get("solver", default)](args.get("solver_args", {}))
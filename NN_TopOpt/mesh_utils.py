@@ -2,8 +2,11 @@ import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.tri as mtri
 from matplotlib.patches import Ellipse, Polygon
-from tqdm import tqdm
 import gmsh
+import time
+from scipy import sparse
+from scipy.sparse import linalg as sla
+from scipy.sparse.csgraph import reverse_cuthill_mckee
 
 def triag_area(point1, point2, point3):
     mat = np.array([[point1[0], point1[1], 1],
@@ -18,9 +21,13 @@ class LoadedMesh2D:
     self.q   is an array with nodes coords
     self.me  is an array with indeces of coords for tetraidal elements
     self.volumes is an array with volumes for each element.
+
+    renumbering ("rcm" or "mmd", see node_ordering) reorders the nodes after
+    loading, self.node_permutation[i] is then the loaded (gmsh) index of
+    node i and self.node_tags the original tags of the reordered nodes.
     """
     
-    def __init__(self, filename):
+    def __init__(self, filename, renumbering=None):
 
         gmsh.initialize()
         gmsh.open(filename)
@@ -62,22 +69,85 @@ class LoadedMesh2D:
         self.elem_tags = np.array(elem_tags)
         self.me = np.array(elem_node_tags) - 1 # indeces start from 1
 
-        # assemle volume list for each component
-        area_list = []
-        print("Compute areas ...")
-        for element in tqdm(self.me):
-            area = triag_area(self.q[int(element[0])], self.q[int(element[1])], self.q[int(element[2])])
-            area_list.append(area)
+        self.node_permutation = np.arange(self.q.shape[0])
+        self.renumbering_report = None
+        if renumbering is not None:
+            self.renumber_nodes(renumbering)
+
+        self._compute_geometry()
 
-        centroid_list = []
-        for element in tqdm(self.me):
-            centroid = self.q[element].sum(0)/3
-            centroid_list.append(centroid)
+    @classmethod
+    def from_arrays(cls, q, me, renumbering=None):
+        """Creates a mesh from node coordinates and triangles (e.g. from mesh_polygon)."""
+        Th = cls.__new__(cls)
+        Th.q = np.asarray(q, dtype=float)
+        Th.me = np.asarray(me, dtype=int)
+        Th.node_tags = np.arange(Th.q.shape[0])
+        Th.elem_tags = np.arange(Th.me.shape[0])
+        Th.node_permutation = np.arange(Th.q.shape[0])
+        Th.renumbering_report = None
+        if renumbering is not None:
+            Th.renumber_nodes(renumbering)
+        Th._compute_geometry()
+        return Th
 
-        self.centroids = np.array(centroid_list)        
-        self.areas = np.array(area_list)
+    @classmethod
+    def from_geometry(cls, q, me, areas, centroids, node_permutation=None, renumbering_report=None):
+        """Creates a mesh from stored (e.g. memory-mapped) arrays, the geometry is not recomputed."""
+        Th = cls.__new__(cls)
+        Th.q = q
+        Th.me = me
+        Th.areas = areas
+        Th.centroids = centroids
+        Th.node_tags = np.arange(q.shape[0])
+        Th.elem_tags = np.arange(me.shape[0])
+        Th.node_permutation = np.arange(q.shape[0]) if node_permutation is None else node_permutation
+        Th.renumbering_report = renumbering_report
+        return Th
+
+    def _compute_geometry(self):
+        # areas and centroids of all elements
+        print("Compute areas ...")
+        ql = self.q[self.me]
+        d1 = ql[:, 1] - ql[:, 0]
+        d2 = ql[:, 2] - ql[:, 0]
+        self.areas = 0.5*np.abs(d1[:, 0]*d2[:, 1] - d1[:, 1]*d2[:, 0])
+        self.centroids = ql.sum(1)/3
         print('Whole area', self.areas.sum())
 
+    def renumber_nodes(self, method="rcm", report=True):
+        """
+        Reorders the nodes (and so the dofs 2n, 2n+1) with node_ordering.
+        q, me and node_tags are permuted consistently, node_permutation maps
+        back to the loaded order. With report, fill-in and factorization time
+        of the stiffness pattern are compared before and after (ordering_report).
+        """
+        perm = node_ordering(self.q, self.me, method)
+        inverse = np.empty_like(perm)
+        inverse[perm] = np.arange(perm.shape[0])
+
+        if report:
+            self.renumbering_report = {"method": method,
+                                       "before": ordering_report(self.q.shape[0], self.me),
+                                       "after": ordering_report(self.q.shape[0], inverse[self.me])}
+            print(f"Node renumbering ({method}):")
+            for key in ["bandwidth", "envelope", "natural", "mmd"]:
+                print(f"  {key}: {self.renumbering_report['before'][key]} -> {self.renumbering_report['after'][key]}")
+
+        self.q = self.q[perm]
+        self.me = inverse[self.me]
+        if len(self.node_tags) == perm.shape[0]:
+            self.node_tags = self.node_tags[perm]
+        self.node_permutation = self.node_permutation[perm]
+
+    def to_loaded_order(self, values):
+        """Maps nodal (nq, ...) or dof (2*nq, ...) arrays back to the node order of the mesh file."""
+        nq = self.q.shape[0]
+        nodal = values.reshape(nq, -1, *values.shape[1:]) if values.shape[0] == 2*nq else values
+        loaded = np.empty_like(nodal)
+        loaded[self.node_permutation] = nodal
+        return loaded.reshape(values.shape)
+
     def plot(self):
         fig = plt.figure()
         x = self.q[:, 0]
@@ -180,3 +250,163 @@ class LoadedMesh2D_ext(LoadedMesh2D):
         # plt.show()
         # tcf = ax.tricontourf(triangulation, xPhys, vmax = vmax, vmin = vmin)
         return tcf  
+
+
+def node_adjacency(nq, me):
+    """Node adjacency graph of a triangle mesh as (nq, nq) sparse matrix (with diagonal)."""
+    rows = np.repeat(me, 3, axis=1).ravel()
+    cols = np.tile(me, (1, 3)).ravel()
+    return sparse.csr_matrix((np.ones(rows.shape[0]), (rows, cols)), shape=(nq, nq))
+
+
+def node_ordering(q, me, method="rcm"):
+    """
+    Returns a node permutation (new -> old index) reducing the bandwidth or
+    the fill-in of the stiffness matrix:
+    "rcm" -- reverse Cuthill-McKee on the node adjacency graph,
+    "mmd" -- minimum degree (SuperLU's MMD on the adjacency pattern).
+    """
+    A = node_adjacency(q.shape[0], me)
+    if method == "rcm":
+        return np.asarray(reverse_cuthill_mckee(A, symmetric_mode=True))
+    elif method == "mmd":
+        lu = sla.splu(node_laplacian(A), permc_spec="MMD_AT_PLUS_A",
+                      diag_pivot_thresh=0.0, options={"SymmetricMode": True})
+        return np.argsort(lu.perm_c)
+    raise ValueError(f"Unknown node ordering: {method}")
+
+
+def node_laplacian(A):
+    # SPD matrix with the pattern of the node adjacency A (shifted graph Laplacian)
+    degree = np.asarray(A.sum(1)).ravel()
+    return (sparse.diags(degree + 1.0) - (A - sparse.diags(A.diagonal()))).tocsc()
+
+
+def ordering_report(nq, me, max_envelope=5e7):
+    """
+    Bandwidth, envelope and factorization of an SPD matrix with the dof
+    pattern of the stiffness matrix in the given node order: fill-in (nnz of
+    the LU factors) and factor time without reordering ("natural", skipped
+    if the envelope exceeds max_envelope) and with SuperLU's MMD ordering
+    as used by the default solver ("mmd").
+    """
+    A = node_adjacency(nq, me)
+    K = sparse.kron(node_laplacian(A), np.array([[2.0, 1.0], [1.0, 2.0]])).tocsc()
+    first = np.minimum.reduceat(A.indices, A.indptr[:-1])
+    envelope = int(4*(np.arange(nq) - first).sum())
+    report = {"bandwidth": int((np.arange(nq) - first).max()), "envelope": envelope}
+
+    for ordering in ["NATURAL", "MMD_AT_PLUS_A"]:
+        name = "natural" if ordering == "NATURAL" else "mmd"
+        if ordering == "NATURAL" and envelope > max_envelope:
+            report[name] = None
+            continue
+        start = time.perf_counter()
+        lu = sla.splu(K, permc_spec=ordering, diag_pivot_thresh=0.0, options={"SymmetricMode": True})
+        report[name] = {"fill": int(lu.L.nnz + lu.U.nnz), "factor_time": time.perf_counter() - start}
+    return report
+
+
+def boundary_loops(q, me, angle_tol=1e-6):
+    """
+    Returns the boundary of a triangle mesh as a list of closed polygons
+    ((n, 2) arrays of corner coordinates), the outer boundary first.
+    Boundary nodes on straight segments are dropped, so the polygons
+    describe the geometry independent of the mesh size.
+    """
+    edges = np.sort(np.concatenate((me[:, [0, 1]], me[:, [1, 2]], me[:, [2, 0]])), axis=1)
+    edges, counts = np.unique(edges, axis=0, return_counts=True)
+    edges = edges[counts == 1]
+
+    # walk the boundary edges into loops
+    neighbours = {}
+    for a, b in edges:
+        neighbours.setdefault(a, []).append(b)
+        neighbours.setdefault(b, []).append(a)
+    visited = set()
+    loops = []
+    for start in neighbours:
+        if start in visited:
+            continue
+        loop = [start]
+        visited.add(start)
+        prev, node = start, neighbours[start][0]
+        while node != start:
+            loop.append(node)
+            visited.add(node)
+            nxt = neighbours[node][0] if neighbours[node][0] != prev else neighbours[node][1]
+            prev, node = node, nxt
+        points = q[loop]
+
+        # keep the corners only
+        d_in = points - np.roll(points, 1, axis=0)
+        d_out = np.roll(points, -1, axis=0) - points
+        cross = d_in[:, 0]*d_out[:, 1] - d_in[:, 1]*d_out[:, 0]
+        corner = np.abs(cross) > angle_tol*np.linalg.norm(d_in, axis=1)*np.linalg.norm(d_out, axis=1)
+        loops.append(points[corner])
+
+    # outer boundary has the largest enclosed area
+    areas = [0.5*np.abs(np.dot(p[:, 0], np.roll(p[:, 1], -1)) - np.dot(p[:, 1], np.roll(p[:, 0], -1))) for p in loops]
+    return [loops[i] for i in np.argsort(areas)[::-1]]
+
+
+def mesh_polygon(loops, meshsize):
+    """
+    Meshes the domain bounded by the polygons loops (outer boundary first,
+    then holes) with gmsh, as create_task does. Returns nodes q and
+    triangles me.
+    """
+    gmsh.initialize()
+    gmsh.option.setNumber('General.Verbosity', 1)
+    model = gmsh.model()
+
+    curve_loops = []
+    for polygon in loops:
+        points = [model.occ.add_point(x, y, 0) for x, y in polygon]
+        lines = [model.occ.add_line(points[i], points[(i + 1) % len(points)]) for i in range(len(points))]
+        curve_loops.append(model.occ.add_curve_loop(lines))
+    model.occ.add_plane_surface(curve_loops)
+    model.occ.synchronize()
+
+    gmsh.option.setNumber('Mesh.MeshSizeMax', meshsize)
+    model.mesh.generate(dim=2)
+
+    node_tags, node_coords, _ = model.mesh.getNodes()
+    elem_tags, elem_node_tags = model.mesh.getElementsByType(2)
+    gmsh.finalize()
+
+    # gmsh node tags are not necessarily contiguous
+    node_index = np.zeros(int(node_tags.max()) + 1, dtype=int)
+    node_index[node_tags.astype(int)] = np.arange(node_tags.shape[0])
+    q = node_coords.reshape(-1, 3)[:, :2]
+    me = node_index[elem_node_tags.astype(int)].reshape(-1, 3)
+
+    # drop nodes which are not used by triangles (geometry points)
+    used = np.unique(me)
+    renumber = -np.ones(q.shape[0], dtype=int)
+    renumber[used] = np.arange(used.shape[0])
+    return q[used], renumber[me]
+
+
+def mesh_hierarchy(q, me, coarse_nodes=500, coarsening=2.0, max_levels=8):
+    """
+    Builds a (non-nested) hierarchy of coarser meshes of the same geometry
+    by remeshing the boundary polygon of (q, me) with gmsh at mesh sizes
+    growing by the coarsening factor, until a mesh has at most
+    coarse_nodes nodes. Returns the list of (q, me) from fine to coarse,
+    without the input mesh.
+    """
+    loops = boundary_loops(q, me)
+    edge_lengths = np.linalg.norm(q[me[:, 1]] - q[me[:, 0]], axis=1)
+    meshsize = edge_lengths.mean()
+
+    levels = []
+    n_nodes = q.shape[0]
+    while n_nodes > coarse_nodes and len(levels) < max_levels:
+        meshsize *= coarsening
+        q_c, me_c = mesh_polygon(loops, meshsize)
+        if q_c.shape[0] >= n_nodes:
+            break
+        levels.append((q_c, me_c))
+        n_nodes = q_c.shape[0]
+    return levels
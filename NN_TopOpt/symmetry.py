@@ -0,0 +1,198 @@
+import copy
+import numpy as np
+from scipy import sparse
+import matplotlib.tri as mtri
+
+# from NN_TopOpt.mesh_utils import LoadedMesh2D, boundary_loops, mesh_polygon
+from mesh_utils import LoadedMesh2D, boundary_loops, mesh_polygon
+# from NN_TopOpt.fem_utils import interpolation_matrix, constrained_nodes, nodal_loads, select_nodes
+from fem_utils import interpolation_matrix, constrained_nodes, nodal_loads, select_nodes
+
+
+def mirror(points, axis, c):
+    """Reflects points about the line points[:, axis] = c."""
+    mirrored = np.array(points, dtype=float)
+    mirrored[:, axis] = 2*c - mirrored[:, axis]
+    return mirrored
+
+
+def problem_load_cases(problem_args):
+    return [case["loads"] for case in problem_args.get("load_cases", [{"loads": problem_args["loads"]}])]
+
+
+def find_mirror_symmetry(Th, problem_args, tol=1e-6):
+    """
+    Checks whether geometry, supports and loads of a problem are symmetric
+    about the vertical or horizontal line through the middle of the bounding
+    box and returns the MirrorSymmetry, or None.
+
+    Supports of the tangential component must be symmetric. Supports of the
+    normal component must be symmetric as well, or a single node: such a pin
+    only removes the rigid translation along the normal (e.g. the pinned end
+    of the MBB beam) and is restored by a rigid shift of the mirrored solution.
+    """
+    q = Th.q
+    loops = boundary_loops(q, Th.me)
+    corners = np.concatenate(loops)
+    size = np.linalg.norm(np.ptp(q, axis=0))
+
+    for axis in (0, 1):
+        c = (q[:, axis].min() + q[:, axis].max())/2
+        q_mirrored = mirror(q, axis, c)
+
+        # geometry: mirrored corners are corners, holes do not cross the axis
+        distances = np.linalg.norm(mirror(corners, axis, c)[:, None] - corners[None], axis=2).min(1)
+        if distances.max() > tol*size:
+            continue
+        if any(loop[:, axis].min() < c - tol*size and loop[:, axis].max() > c + tol*size for loop in loops[1:]):
+            continue
+        sides = np.sign(loops[0][:, axis] - c)
+        sides = sides[np.abs(loops[0][:, axis] - c) > tol*size]
+        if np.count_nonzero(sides != np.roll(sides, 1)) > 2:
+            # the outer boundary crosses the axis more than twice
+            continue
+
+        # supports
+        fixed = constrained_nodes(q, problem_args)
+        fixed_mirrored = constrained_nodes(q_mirrored, problem_args)
+        if np.any(fixed[:, 1-axis] != fixed_mirrored[:, 1-axis]):
+            continue
+        pin = None
+        if np.any(fixed[:, axis] != fixed_mirrored[:, axis]):
+            if fixed[:, axis].sum() != 1:
+                continue
+            pin = q[fixed[:, axis]][0]
+
+        # loads, the normal component changes sign
+        symmetric_loads = True
+        for load_list in problem_load_cases(problem_args):
+            loads = nodal_loads(q, load_list)
+            loads_mirrored = nodal_loads(q_mirrored, load_list)
+            loads_mirrored[:, axis] *= -1
+            symmetric_loads &= np.allclose(loads, loads_mirrored)
+        if not symmetric_loads:
+            continue
+
+        return MirrorSymmetry(Th, loops, axis, c, pin)
+    return None
+
+
+def clip_polygon(polygon, axis, c):
+    # Sutherland-Hodgman clipping of a polygon to the half plane p[axis] <= c
+    clipped = []
+    for a, b in zip(polygon, np.roll(polygon, -1, axis=0)):
+        a_in, b_in = a[axis] <= c, b[axis] <= c
+        if a_in:
+            clipped.append(a)
+        if a_in != b_in:
+            t = (c - a[axis])/(b[axis] - a[axis])
+            point = a + t*(b - a)
+            point[axis] = c
+            clipped.append(point)
+    return np.array(clipped)
+
+
+class MirrorSymmetry:
+    """
+    Mirror symmetry of a problem about the line q[:, axis] = c.
+
+    The problem is solved on the half q[:, axis] <= c, meshed with gmsh at
+    the mesh size of the full mesh, with the normal displacement fixed on the
+    axis. Nodal loads of the half are scaled to the magnitude of the loads of
+    the full problem (the meshes select different numbers of loaded nodes). Densities and displacements are mapped back
+    to the elements and nodes of the full mesh.
+    """
+
+    def __init__(self, Th_full, loops, axis, c, pin):
+        self.Th_full = Th_full
+        self.loops = loops
+        self.axis = axis
+        self.c = c
+        self.pin = pin
+        self.tol = 1e-6*np.linalg.norm(np.ptp(Th_full.q, axis=0))
+
+    def half_mesh(self, renumbering=None):
+        half_loops = [clip_polygon(self.loops[0], self.axis, self.c)]
+        half_loops += [loop for loop in self.loops[1:] if loop[:, self.axis].max() <= self.c + self.tol]
+        edge_lengths = np.linalg.norm(self.Th_full.q[self.Th_full.me[:, 1]] - self.Th_full.q[self.Th_full.me[:, 0]], axis=1)
+        q, me = mesh_polygon(half_loops, edge_lengths.mean())
+        self.Th_half = LoadedMesh2D.from_arrays(q, me, renumbering)
+        self.build_maps()
+        return self.Th_half
+
+    def half_problem(self, problem_args):
+        """Problem definition on the half mesh: symmetry supports on the axis, pin released."""
+        half = copy.deepcopy(problem_args)
+        normal, tangential = ["fixed_x", "fixed_y"][self.axis], ["fixed_x", "fixed_y"][1-self.axis]
+
+        if self.pin is not None:
+            # the pin's normal support is replaced by the symmetry supports
+            selects_pin = lambda case: select_nodes(self.pin[None], case[0], case[1])[0]
+            half[normal] = [case for case in half[normal] if not selects_pin(case)]
+            half[tangential] += [case for case in half["fixed_xy"] if selects_pin(case)]
+            half["fixed_xy"] = [case for case in half["fixed_xy"] if not selects_pin(case)]
+
+        lo, hi = self.Th_full.q[:, 1-self.axis].min(), self.Th_full.q[:, 1-self.axis].max()
+        axis_line = [self.c, [lo, hi]] if self.axis == 0 else [[lo, hi], self.c]
+        half[normal] = half[normal] + [axis_line]
+        half["symmetry"] = {"axis": self.axis, "c": self.c}
+        return half
+
+    def side_weights(self, q):
+        # 1 on the kept side, 0.5 on the axis (shared by both halves), 0 on the mirrored side
+        on_axis = np.isclose(q[:, self.axis], self.c, atol=self.tol)
+        return np.where(on_axis, 0.5, (q[:, self.axis] < self.c).astype(float))
+
+    def symmetric_loads(self, q, load_list):
+        """
+        (nq, 2) nodal loads of a "loads" list on the half mesh q. Each entry is
+        scaled so that its total equals the part of the entry on the kept side
+        of the full mesh, as the meshes select different numbers of nodes.
+        """
+        weights = self.side_weights(q)
+        weights_full = self.side_weights(self.Th_full.q)
+        loads = np.zeros((q.shape[0], 2))
+        for case in load_list:
+            selected = select_nodes(q, case[0][0], case[0][1])
+            full_total = weights_full[select_nodes(self.Th_full.q, case[0][0], case[0][1])].sum()
+            half_total = weights[selected].sum()
+            scale = full_total/half_total if half_total > 0 else 1.0
+            loads[selected] = scale*weights[selected, None]*np.asarray(case[1], dtype=float)
+        return loads
+
+    def build_maps(self):
+        # full mesh points folded onto the half, normal components flip on the mirrored side
+        q_full = self.Th_full.q
+        mirrored = q_full[:, self.axis] > self.c
+        q_folded = np.where(mirrored[:, None], mirror(q_full, self.axis, self.c), q_full)
+
+        P = interpolation_matrix(q_folded, self.Th_half.q, self.Th_half.me)
+        signs = np.ones((q_full.shape[0], 2))
+        signs[mirrored, self.axis] = -1
+        self.displacement_map = sparse.diags(signs.ravel()) @ sparse.kron(P, sparse.eye(2)).tocsr()
+
+        centroids = self.Th_full.centroids
+        c_mirrored = centroids[:, self.axis] > self.c
+        c_folded = np.where(c_mirrored[:, None], mirror(centroids, self.axis, self.c), centroids)
+        triangulation = mtri.Triangulation(self.Th_half.q[:, 0], self.Th_half.q[:, 1], self.Th_half.me)
+        self.element_map = triangulation.get_trifinder()(c_folded[:, 0], c_folded[:, 1])
+        for i in np.flatnonzero(self.element_map < 0):
+            self.element_map[i] = np.argmin(np.linalg.norm(self.Th_half.centroids - c_folded[i], axis=1))
+
+        if self.pin is not None:
+            pin_mirrored = self.pin[self.axis] > self.c
+            pin_folded = mirror(self.pin[None], self.axis, self.c) if pin_mirrored else self.pin[None]
+            self.pin_map = interpolation_matrix(pin_folded, self.Th_half.q, self.Th_half.me)
+            self.pin_sign = -1 if pin_mirrored else 1
+
+    def mirror_density(self, x_half):
+        """Element densities of the full mesh."""
+        return x_half[self.element_map]
+
+    def mirror_displacement(self, u_half):
+        """Nodal displacements (dofs 2n, 2n+1) of the full mesh, shifted to satisfy the released pin."""
+        u_full = self.displacement_map @ u_half
+        if self.pin is not None:
+            u_pin = self.pin_sign*(self.pin_map @ u_half.reshape(-1, 2, *u_half.shape[1:])[:, self.axis])
+            u_full.reshape(-1, 2, *u_full.shape[1:])[:, self.axis] -= u_pin[0]
+        return u_full
@@ -0,0 +1,91 @@
+import numpy as np
+import torch
+
+
+class FEMSolve(torch.autograd.Function):
+    """
+    Differentiable FEM solve U = K(x)^-1 F for the element densities x (SIMP
+    stiffnesses Emin + x^penal (Emax-Emin)), all load cases at once.
+
+    The backward pass is one adjoint solve K lambda = dL/dU with the cached
+    factorization, dL/dx_e = -lambda_e^T dK_e/dx_e u_e, so the gradient of any
+    objective of U costs one extra back-substitution.
+    """
+
+    @staticmethod
+    def forward(ctx, x, fem):
+        x_np = x.detach().cpu().numpy()
+        U = fem.solve(x_np)
+        ctx.fem = fem
+        ctx.x = x_np
+        ctx.U = U
+        ctx.x_dtype = x.dtype
+        return torch.from_numpy(U)
+
+    @staticmethod
+    def backward(ctx, grad_U):
+        dx = ctx.fem.sensitivities(ctx.x, ctx.U, grad_U.detach().cpu().numpy())
+        return torch.from_numpy(dx).to(ctx.x_dtype), None
+
+
+class TorchFEM:
+    """
+    Torch interface to the FEM core of a TopOptimizer2D: the stiffness
+    matrix is assembled on its sparsity pattern (assembly plans or
+    matrix-free operators) and solved with its linear solver backend.
+    A factorization is reused as long as the densities do not change, in
+    particular the one of the current optimizer iteration.
+    """
+
+    def __init__(self, top_opt):
+        self.top_opt = top_opt
+        # densities and displacements of the last solve
+        self.x = None
+        self.U = None
+
+    def solve(self, x):
+        """Returns the (ndof, n_cases) displacements for the densities x."""
+        if self.x is not None and np.array_equal(x, self.x):
+            return self.U
+        top = self.top_opt
+        K_free, F_free, _ = top.build_system(x)
+        top.factorize(x, K_free)
+        U = top.U.copy()
+        U[top.free_dof] = top.solver.solve(F_free, x0=top.U[top.free_dof])
+        self.x = x.copy()
+        self.U = U
+        return U
+
+    def sensitivities(self, x, U, G):
+        """Returns dL/dx for the displacements U(x) and G = dL/dU (both (ndof, n_cases))."""
+        top = self.top_opt
+        ce = top.adjoint_sensitivities(x, G, U)
+        return -ce*top.penal*x**(top.penal-1)*(top.Emax-top.Emin)
+
+    def displacements(self, x):
+        """Differentiable displacements (ndof, n_cases) for the density tensor x."""
+        return FEMSolve.apply(x, self)
+
+    def compliance(self, x):
+        """
+        Differentiable compliance F^T U(x) for the density tensor x, load cases
+        aggregated as in the optimizer (prescribed displacements are zero).
+        """
+        top = self.top_opt
+        U = self.displacements(x)
+        obj_cases = (torch.from_numpy(top.F)*U).sum(0)
+        if top.n_cases == 1:
+            obj = obj_cases[0]
+        elif top.load_aggregation == "max":
+            obj = (torch.from_numpy(top.case_weights)*obj_cases).max()
+        else:
+            obj = torch.from_numpy(top.case_weights) @ obj_cases
+        return obj.to(x.dtype)
+
+    def objective(self, x):
+        """Differentiable objective of the optimizer (compliance or "displacement") for the density tensor x."""
+        top = self.top_opt
+        if top.objective == "compliance":
+            return self.compliance(x)
+        dJdU = torch.from_numpy(top.objective_gradient())
+        return (dJdU*self.displacements(x)).sum().to(x.dtype)
@@ -7,7 +7,7 @@ sys.path.append(os.path.abspath('../NN_TopOpt'))
 from mesh_utils import LoadedMesh2D 
 import json
 
-def create_task(poligone_vertices, task_name, constraints, loads, meshsize = 0.005):
+def create_task(poligone_vertices, task_name, constraints, loads, meshsize = 0.005, structured = False):
     gmsh.initialize()
     model = gmsh.model()
 
@@ -28,6 +28,15 @@ def create_task(poligone_vertices, task_name, constraints, loads, meshsize = 0.0
 
     gmsh.option.setNumber('Mesh.MeshSizeMax', meshsize)
 
+    # regular triangulation of a quadrilateral domain (structured_mesh fast path)
+    if structured:
+        assert len(poligone_vertices) == 4, "structured mesh requires 4 vertices"
+        for i, line in enumerate(lines):
+            a, b = poligone_vertices[i], poligone_vertices[(i + 1) % 4]
+            length = ((b[0] - a[0])**2 + (b[1] - a[1])**2)**0.5
+            model.mesh.set_transfinite_curve(line, max(2, round(length/meshsize) + 1))
+        model.mesh.set_transfinite_surface(face)
+
     #mesh generation
     model.mesh.generate(dim=2)
 
@@ -0,0 +1,57 @@
+import os
+import sys
+from functools import partial
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "NN_TopOpt"))
+sys.path.insert(0, ROOT)
+
+
+class FixedDensity:
+    """Method that hands the same density field to the optimizer for a given number of iterations."""
+
+    def __init__(self, density, args, iterations=2):
+        self.density = density
+        self.iterations = iterations
+        self.global_i = 0
+        self.stop_flag = False
+        self.meta = {}
+        self.ce = None
+
+    def get_x(self, args):
+        self.ce = args.get("ce")
+        x = self.density(args["Th"])
+        self.global_i += 1
+        self.stop_flag = self.global_i == self.iterations
+        return x
+
+
+def central_hole(Th):
+    # densities at the OC floor in the central part of the domain, solid elsewhere
+    c = Th.centroids
+    extent = c.max(0) - c.min(0)
+    return np.where((np.abs(c - c.mean(0))/extent < 0.3).all(1), 0.001, 1.0)
+
+
+@pytest.fixture
+def run_dir(tmp_path, monkeypatch):
+    # the optimizers read ../test_problems and write their logs to experiments/
+    os.symlink(os.path.join(ROOT, "test_problems"), tmp_path / "test_problems")
+    (tmp_path / "run").mkdir()
+    monkeypatch.chdir(tmp_path / "run")
+    return tmp_path / "run"
+
+
+@pytest.fixture
+def optimizer(run_dir):
+    from TopOpt import TopOptimizer2D
+
+    def run(density, problem_name="cantilever_beam_low_resolution", **args):
+        op = TopOptimizer2D({"fixed": partial(FixedDensity, density)},
+                            {"problem_name": problem_name, "method": "fixed", "penal": 3, **args})
+        op.optimize()
+        return op
+    return run
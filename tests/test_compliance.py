@@ -0,0 +1,18 @@
+import numpy as np
+
+
+def mixed_density(Th):
+    rng = np.random.default_rng(0)
+    return rng.uniform(0.01, 1, Th.me.shape[0])
+
+
+def test_strain_energy_density(optimizer):
+    op = optimizer(mixed_density, strain_energy_density=True)
+    x = mixed_density(op.Th)
+
+    sed = np.empty(op.nme)
+    for e in range(op.nme):
+        u_e = op.u[op.edof[e]]
+        E_e = op.Emin + x[e]**op.penal*(op.Emax - op.Emin)
+        sed[e] = 0.5*E_e*u_e @ op.K_sep[e].reshape(6, 6) @ u_e/op.Th.areas[e]
+    np.testing.assert_allclose(op.sed, sed, rtol=1e-10)
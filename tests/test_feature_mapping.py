@@ -0,0 +1,67 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+import yaml
+
+from conftest import ROOT
+
+pytest.importorskip("lightning")
+from NN_TopOpt import NN_TopOpt as feature_mapping
+
+CONFIG = os.path.join(ROOT, "configs/NN_top_optimization/FM_NN_Heaviside/MBB_beam_half_fm_ae_hv.yaml")
+
+
+def uniform_density(Th):
+    return 0.5*np.ones(Th.me.shape[0])
+
+
+@pytest.fixture
+def float32_ce(optimizer):
+    # element compliances handed to the feature-mapping models in the float32 mode
+    op = optimizer(uniform_density, problem_name="MBB_beam_half", fem_precision="float32")
+    assert op.ce.dtype == np.float32
+    return op
+
+
+@pytest.fixture
+def method_args(float32_ce, run_dir):
+    with open(CONFIG) as fp:
+        params = yaml.safe_load(fp)["params"]
+    params["config_dir"] = os.path.join(ROOT, params["config_dir"].lstrip("./"))
+    return {"Th": float32_ce.Th, "penal": float32_ce.penal, "args": params, "problem_config": float32_ce.problem_args,
+            "Emin": float32_ce.Emin, "Emax": float32_ce.Emax}
+
+
+def random_decoder_weights(run_dir, args):
+    # CombinedMappingDecoderSDF loads ../model_weights and ../z_limits, untrained weights are enough here
+    name = args["saved_model_name"]
+    with open(f"{args['config_dir']}/{name}.yaml") as fp:
+        config = yaml.safe_load(fp)
+    params = {**config["model"]["params"], "input_dim": 17}
+    model = feature_mapping.models[config["model"]["type"]](**params)
+    for directory in ["model_weights", "z_limits"]:
+        (run_dir.parent / directory).mkdir()
+    torch.save(model.state_dict(), run_dir.parent / "model_weights" / f"{name}_full.pt")
+    latent_dim = params["latent_dim"]
+    np.savez(run_dir.parent / "z_limits" / f"{name}_stats.npz", latent_mins=-np.ones(latent_dim), latent_maxs=np.ones(latent_dim))
+
+
+@pytest.mark.parametrize("model_name", ["GaussianSplattingCompliance", "CombinedMappingDecoderSDF", "FM_AE_DeepSDF"])
+def test_float32_compliances(float32_ce, method_args, run_dir, model_name):
+    if model_name == "FM_AE_DeepSDF" and not hasattr(feature_mapping, "AE_DeepSDF_explicit_radius"):
+        pytest.skip("FeatureMappingDecSDF needs AE_DeepSDF_explicit_radius, which this tree does not define")
+    if model_name == "CombinedMappingDecoderSDF":
+        random_decoder_weights(run_dir, method_args["args"])
+    model_class = {"GaussianSplattingCompliance": feature_mapping.GaussianSplattingCompliance,
+                   "CombinedMappingDecoderSDF": feature_mapping.CombinedMappingDecoderSDF,
+                   "FM_AE_DeepSDF": feature_mapping.FeatureMappingDecSDF}[model_name]
+
+    coords = torch.tensor(float32_ce.Th.centroids)
+    volumes = torch.tensor(float32_ce.Th.areas)
+    model = model_class(coords, volumes, method_args)
+    model.get_x(1)
+    loss, _ = model(torch.from_numpy(float32_ce.ce), 1)
+    loss.backward()
+    assert torch.isfinite(loss)
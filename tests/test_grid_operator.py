@@ -0,0 +1,57 @@
+import numpy as np
+
+from fem_utils import ElementStiffnessOperator, GridStiffnessOperator, classify_elements, structured_grid
+
+
+def lattice(nx, ny, alternating=False):
+    # (ny+1, nx+1) grid of nodes, every cell split along a diagonal
+    X, Y = np.meshgrid(np.linspace(0, 3, nx+1), np.linspace(0, 1, ny+1))
+    q = np.stack((X.ravel(), Y.ravel()), axis=1)
+    I, J = [a.ravel() for a in np.meshgrid(np.arange(nx), np.arange(ny))]
+    n00, n10, n01, n11 = J*(nx+1) + I, J*(nx+1) + I+1, (J+1)*(nx+1) + I, (J+1)*(nx+1) + I+1
+    flip = ((I + J) % 2 == 1) if alternating else np.zeros(I.shape, dtype=bool)
+    me = np.concatenate((np.where(flip[:, None], np.stack((n00, n10, n01), 1), np.stack((n00, n10, n11), 1)),
+                         np.where(flip[:, None], np.stack((n10, n11, n01), 1), np.stack((n00, n11, n01), 1))))
+    return q, me
+
+
+def operators(nx=7, ny=4, dofs=None):
+    q, me = lattice(nx, ny)
+    element_types, representatives = classify_elements(q, me)
+    rng = np.random.default_rng(0)
+    A = rng.standard_normal((representatives.shape[0], 6, 6))
+    K_sep = (A @ A.transpose(0, 2, 1)).reshape(-1, 36)
+    edof = (2*me[:, :, None] + np.arange(2)).reshape(-1, 6)
+    ndof = 2*q.shape[0]
+    grid = structured_grid(q, me, element_types)
+    assert grid is not None
+    grouped = ElementStiffnessOperator(edof, K_sep, ndof, dofs=dofs, element_types=element_types)
+    stencil = GridStiffnessOperator(*grid, K_sep, ndof, dofs=dofs)
+    E = rng.uniform(0.01, 1, me.shape[0])
+    grouped.set_E(E)
+    stencil.set_E(E)
+    return grouped, stencil, rng
+
+
+def test_grid_operator_matches_grouped_elements():
+    grouped, stencil, rng = operators()
+    u, v = rng.standard_normal((2, grouped.ndof))
+    np.testing.assert_allclose(stencil.apply(u), grouped.apply(u), rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(stencil.element_compliance(u), grouped.element_compliance(u), rtol=1e-12)
+    np.testing.assert_allclose(stencil.element_compliance(u, v=v), grouped.element_compliance(u, v=v),
+                               rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(stencil.diagonal(), grouped.diagonal(), rtol=1e-12)
+
+
+def test_grid_operator_free_dofs():
+    free_dof = np.arange(10, 2*8*5)
+    grouped, stencil, rng = operators(dofs=free_dof)
+    x = rng.standard_normal((free_dof.shape[0], 2))
+    np.testing.assert_allclose(stencil @ x, grouped @ x, rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(stencil.diagonal(), grouped.diagonal(), rtol=1e-12)
+
+
+def test_alternating_diagonals_keep_grouped_path():
+    q, me = lattice(6, 4, alternating=True)
+    element_types, _ = classify_elements(q, me)
+    assert structured_grid(q, me, element_types) is None
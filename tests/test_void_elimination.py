@@ -0,0 +1,12 @@
+import numpy as np
+
+from conftest import central_hole
+
+
+def test_void_elimination_compact_storage(optimizer):
+    compact = optimizer(central_hole, problem_name="MBB_beam", void_elimination=True, element_storage="compact")
+    full = optimizer(central_hole, problem_name="MBB_beam", void_elimination=True)
+
+    meta = compact.fem_meta["void_elimination"]
+    assert meta["eliminated_dofs"] > 0 and not meta["fallback"]
+    np.testing.assert_allclose(compact.u, full.u, rtol=0, atol=1e-10*np.abs(full.u).max())